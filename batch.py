@@ -0,0 +1,276 @@
+"""Headless batch tuning curves
+
+Computes the tuning curve of every selected (file, test, channel) across a pool
+of worker processes, and writes the spike count grid (.npz) and a contour plot
+(.png) of each to an output directory. With --pyramids, it instead builds
+the min/max pyramid sidecar the trace view reads, for each file.
+
+Examples::
+
+    python batch.py data/*.hdf5 --tests 2-5 --channels 1 --threshold auto -o curves
+    python batch.py data/*.hdf5 --pyramids
+"""
+import argparse
+import glob
+import multiprocessing
+import os
+import sys
+import traceback
+
+import matplotlib
+matplotlib.use('Agg')
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+from util import peakstats, tuning
+from util.datasource import DataSession, num_channels
+from util.pyramidcache import PyramidCache
+from util.spikestore import stored_spikes
+
+# automatic threshold methods, 'auto' being the original 'peak' method
+THRESHOLD_METHODS = ('auto', 'peak', 'mad', 'percentile')
+
+
+def parse_tests(selectors, available):
+    """Selects tests by name ('test_3'), number ('3') or number range ('2-5')
+
+    :param selectors: test selectors, or None for all tests
+    :type selectors: list(str)
+    :param available: names of the tests in a file
+    :type available: list(str)
+    :returns: list(str) -- selected test names, in file order
+    """
+    if not selectors:
+        return list(available)
+    numbers = set()
+    for selector in selectors:
+        for part in selector.split(','):
+            part = part.strip().replace('test_', '')
+            if '-' in part:
+                first, last = part.split('-')
+                numbers.update(range(int(first), int(last) + 1))
+            elif part:
+                numbers.add(int(part))
+    return [test for test in available if int(test.replace('test_', '')) in numbers]
+
+
+def run_job(job):
+    """Computes and saves one tuning curve, in a worker process
+
+    :param job: (filename, test, channel, nchannels, threshold, options) -- channel is 0-based
+    :returns: (job name, error message or None)
+    """
+    filename, test, channel, nchannels, threshold, options = job
+    base = os.path.splitext(os.path.basename(filename))[0]
+    name = '%s_%s_channel_%d' % (base, test, channel + 1)
+    try:
+        session = DataSession(filename)
+        try:
+            dset = session.dataset(test)
+            fs = session.info(test).samplerate
+            if options['store'] is None:
+                curve = tuning.tuning_curve(dset, fs, session.stim_table(test), threshold, channel,
+                                            options['window'], options['abs'])
+            else:
+                spikes, _ = stored_spikes(options['store'], filename, dset, fs, test, threshold, channel, options['abs'])
+                spikes = tuning.window_spikes(spikes, options['window'], fs)
+                counts, latency = tuning.counts_latency(*(spikes + (fs,)))
+                curve = tuning.curve_from_counts(session.stim_table(test), counts, latency)
+        finally:
+            session.close()
+
+        out = os.path.join(options['output'], name)
+        np.savez(out + '.npz', frequency=curve.frequency, intensity=curve.intensity, Z=curve.Z,
+                 spikes=curve.spikes, presentations=curve.presentations, cells=curve.cells, threshold=threshold)
+        title = base + ' ' + test.replace('test_', 'Test ')
+        if nchannels > 1:
+            title += ' Channel ' + str(channel + 1)
+        levels = None
+        if options['levels'] is not None:
+            levels = tuning.contour_levels(options['zmin'], options['zmax'], options['levels'])
+        fig = Figure()
+        FigureCanvasAgg(fig)
+        tuning.draw(fig, curve, title, threshold, levels)
+        fig.savefig(out + '.png')
+    except Exception:
+        return name, traceback.format_exc()
+    return name, None
+
+
+def run_stats_job(job):
+    """Computes the peak statistics of every channel of a test, in a worker process
+
+    :param job: (filename, test, whether to sketch the channels too)
+    :returns: (filename, test, :class:`PeakStats<util.peakstats.PeakStats>` or None, error message or None)
+    """
+    filename, test, sketches = job
+    try:
+        session = DataSession(filename)
+        try:
+            stats = peakstats.peak_stats(session.dataset(test), sketches=sketches)
+        finally:
+            session.close()
+    except Exception:
+        return filename, test, None, traceback.format_exc()
+    return filename, test, stats, None
+
+
+def auto_thresholds(pool, jobs, method, **kwargs):
+    """Fills in the threshold of jobs from the peak statistics of their tests,
+    computed once per test for all its channels
+
+    :param method: 'peak', 'mad' or 'percentile', see :meth:`PeakStats.threshold<util.peakstats.PeakStats.threshold>`
+    :param kwargs: parameters of the method, passed to :meth:`PeakStats.threshold<util.peakstats.PeakStats.threshold>`
+
+    :returns: (jobs with a threshold, number of jobs whose test could not be read)
+    """
+    # only the noise methods need the slower sketches of the signal
+    sketches = method != 'peak'
+    tests = sorted(set((job[0], job[1], sketches) for job in jobs))
+    stats = {}
+    for filename, test, test_stats, error in pool.imap_unordered(run_stats_job, tests):
+        if error is None:
+            stats[(filename, test)] = test_stats
+        else:
+            sys.stderr.write('failed statistics of ' + filename + ' ' + test + '\n' + error)
+
+    ready = []
+    for filename, test, channel, nchannels, _, options in jobs:
+        if (filename, test) in stats:
+            try:
+                threshold = stats[(filename, test)].threshold(method, channel, **kwargs)
+            except Exception:
+                sys.stderr.write('failed threshold of ' + filename + ' ' + test + ' channel ' + str(channel + 1)
+                                 + '\n' + traceback.format_exc())
+                continue
+            ready.append((filename, test, channel, nchannels, threshold, options))
+    return ready, len(jobs) - len(ready)
+
+
+def run_pyramid_job(job):
+    """Builds the pyramid sidecar of one file, in a worker process
+
+    :param job: (filename, test selectors)
+    :returns: (filename, error message or None)
+    """
+    filename, selectors = job
+    try:
+        session = DataSession(filename)
+        try:
+            cache = PyramidCache(filename)
+            try:
+                cache.build(session, parse_tests(selectors, session.tests()))
+            finally:
+                cache.close()
+        finally:
+            session.close()
+    except Exception:
+        return filename, traceback.format_exc()
+    return filename, None
+
+
+def find_files(patterns):
+    """Expands glob patterns into data file names, warning about patterns that match nothing"""
+    filenames = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern))
+        if not matches:
+            sys.stderr.write('No files match ' + pattern + '\n')
+        filenames.extend(matches)
+    return filenames
+
+
+def build_jobs(args):
+    """Expands files, tests and channels into the list of jobs to run"""
+    filenames = find_files(args.files)
+    if args.pyramids:
+        return [(filename, args.tests) for filename in filenames]
+
+    options = {'window': args.window, 'abs': not args.no_abs,
+               'output': args.output, 'levels': args.levels, 'zmin': args.zmin, 'zmax': args.zmax,
+               'store': args.spike_store}
+    jobs = []
+    for filename in filenames:
+        session = DataSession(filename)
+        try:
+            for test in parse_tests(args.tests, session.tests()):
+                channels = num_channels(session.dataset(test))
+                if args.channels:
+                    selected = [c - 1 for c in args.channels if c <= channels]
+                else:
+                    selected = range(channels)
+                for channel in selected:
+                    # automatic thresholds are filled in by auto_thresholds
+                    threshold = None if args.threshold in THRESHOLD_METHODS else float(args.threshold)
+                    jobs.append((filename, test, channel, channels, threshold, options))
+        finally:
+            session.close()
+    return jobs
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compute tuning curves for Sparkle data files without the GUI')
+    parser.add_argument('files', nargs='+', help='HDF5 data files, or glob patterns of them')
+    parser.add_argument('-t', '--tests', nargs='+', help="tests to process, by name, number or range, e.g. test_1 3 5-8 (default: all)")
+    parser.add_argument('-c', '--channels', nargs='+', type=int, help='channel numbers to process, starting at 1 (default: all)')
+    parser.add_argument('--threshold', default='auto',
+                        help="spike threshold in V, or a method to compute it for each channel: "
+                             "'auto' or 'peak' (0.7 x mean peak of the reps of all traces, default), "
+                             "'mad' (--noise-factor x median(|x|)/0.6745) or 'percentile' (--percentile quantile of |x|)")
+    parser.add_argument('--noise-factor', type=float, default=peakstats.NOISE_FACTOR,
+                        help='multiple of the noise level for --threshold mad (default: %(default)s)')
+    parser.add_argument('--percentile', type=float, default=peakstats.PERCENTILE,
+                        help='quantile of |x|, between 0 and 1, for --threshold percentile (default: %(default)s)')
+    parser.add_argument('--window', nargs=2, type=float, metavar=('XMIN', 'XMAX'), help='only count spikes between these times (s)')
+    parser.add_argument('--no-abs', action='store_true', help='threshold the signal instead of its absolute value')
+    parser.add_argument('--levels', type=int, help='number of contour levels, between --zmin and --zmax')
+    parser.add_argument('--zmin', type=float, default=0)
+    parser.add_argument('--zmax', type=float, default=5)
+    parser.add_argument('--spike-store', metavar='PATH',
+                        help='reuse spikes detected in earlier runs with the same parameters, kept in this SQLite file')
+    parser.add_argument('-o', '--output', default='.', help='directory to write results to')
+    parser.add_argument('--pyramids', action='store_true', help='build the trace view pyramid sidecar of each file, instead of tuning curves')
+    parser.add_argument('-j', '--processes', type=int, default=multiprocessing.cpu_count(), help='number of worker processes')
+    args = parser.parse_args(argv)
+
+    if args.threshold not in THRESHOLD_METHODS:
+        try:
+            float(args.threshold)
+        except ValueError:
+            parser.error('--threshold must be a number or one of ' + ', '.join(THRESHOLD_METHODS))
+    if not os.path.isdir(args.output):
+        os.makedirs(args.output)
+
+    jobs = build_jobs(args)
+    failures = 0
+    pool = multiprocessing.Pool(max(1, min(args.processes, len(jobs))))
+    try:
+        if not args.pyramids and args.threshold in THRESHOLD_METHODS:
+            if args.threshold == 'mad':
+                jobs_ready, failures = auto_thresholds(pool, jobs, 'mad', factor=args.noise_factor)
+            elif args.threshold == 'percentile':
+                jobs_ready, failures = auto_thresholds(pool, jobs, 'percentile', q=args.percentile)
+            else:
+                jobs_ready, failures = auto_thresholds(pool, jobs, 'peak')
+        else:
+            jobs_ready = jobs
+        for name, error in pool.imap_unordered(run_pyramid_job if args.pyramids else run_job, jobs_ready):
+            if error is None:
+                print('done ' + name)
+            else:
+                failures += 1
+                sys.stderr.write('failed ' + name + '\n' + error)
+    finally:
+        pool.close()
+        pool.join()
+    if args.pyramids:
+        print('%d of %d pyramid sidecars built' % (len(jobs) - failures, len(jobs)))
+    else:
+        print('%d of %d tuning curves written to %s' % (len(jobs) - failures, len(jobs), args.output))
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    sys.exit(main())
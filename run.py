@@ -1,11 +1,9 @@
-import operator
 import os
 import sys
 import ctypes
 import glob
 import json
 
-import h5py
 import numpy as np
 import scipy.stats as stats
 
@@ -19,7 +17,23 @@ from PyQt4 import QtCore, QtGui
 
 from ui.tuning_curves_ui import Ui_Form_tuning_curves
 
-from util.spikestats import get_spike_times
+from util import spikestats, tracestats, tuning
+from util.datasource import DataSession, TraceBlock, num_channels
+from util.envelope import MinMaxPyramid
+from util.pyqtgraph_widgets import PSTHWidget
+from util.spikememo import SpikeMemo
+from util.spikestore import default_path
+from util.traceloader import TraceLoader
+from util.workers import PeakStatsWorker, ThresholdSweepWorker, TuningCurveWorker
+
+# width of the PSTH bins under the trace view (s)
+PSTH_BINSZ = 0.001
+# memory budget of the spikes of the tests analyzed in a session (bytes)
+SPIKE_MEMO_BYTES = 64 * 2 ** 20
+# whether the trace view keeps the pyramids of the traces it shows in a sidecar next to the data file
+PYRAMID_SIDECAR = True
+# automatic threshold methods, in the order of the method combo box
+THRESHOLD_METHODS = ['peak', 'mad', 'percentile']
 
 
 class MyForm(QtGui.QMainWindow):
@@ -30,6 +44,7 @@ class MyForm(QtGui.QMainWindow):
         self.dialog = QtGui.QMainWindow
 
         self.filename = ''
+        self.session = None
         self.threshold = 0
 
         self.backup_dir = ''
@@ -37,12 +52,65 @@ class MyForm(QtGui.QMainWindow):
 
         self.message_num = 0
 
+        self.tuning_thread = None
+        self.tuning_worker = None
+        self.tuning_plot = None
+        self.tuning_result = None
+        # Spikes of the tests analyzed in this session, by channel and threshold
+        self.spike_memo = SpikeMemo(SPIKE_MEMO_BYTES)
+
+        self.sweep_thread = None
+        self.sweep_worker = None
+        self.sweep_title = None
+        self.sweep_result = None
+        # Per-rep peak statistics of each test, for automatic thresholds of any channel
+        self.peak_stats = {}
+        self.stats_thread = None
+        self.stats_worker = None
+
+        self.pushButton_sweep = QtGui.QPushButton('Sweep', self.ui.groupBoxThreshold)
+        self.pushButton_sweep.setFont(self.ui.pushButton_auto_threshold.font())
+        self.pushButton_sweep.setToolTip('Plot spike counts against threshold')
+        self.ui.gridLayout_6.addWidget(self.pushButton_sweep, 1, 2, 1, 1)
+
+        self.comboBox_threshold_method = QtGui.QComboBox(self.ui.groupBoxThreshold)
+        self.comboBox_threshold_method.setFont(self.ui.pushButton_auto_threshold.font())
+        self.comboBox_threshold_method.addItems(['Peak', 'MAD', 'Percentile'])
+        self.comboBox_threshold_method.setToolTip('Auto threshold method: 0.7 x mean peak of the selected trace, '
+                                                  '4 x noise level median(|x|)/0.6745, or 99.9th percentile of |x|')
+        self.ui.gridLayout_6.addWidget(self.comboBox_threshold_method, 1, 3, 1, 1)
+
+        # Traces for the view are read on a background thread
+        self.view_request = None
+        self.view_rep = []
+        self.loader = TraceLoader(sidecar=PYRAMID_SIDECAR, parent=self)
+        self.loader.traceLoaded.connect(self.show_trace)
+        self.loader.loadFailed.connect(self.trace_load_failed)
+        self.loader.spikesDetected.connect(self.show_detected_spikes)
+        self.loader.start()
+
+        # Spikes of the shown trace, as a raster over it and a PSTH below it
+        # Spikes are detected by the loader; only the latest request is drawn
+        self.shown_trace = None
+        self.spike_request = None
+        self.psth = PSTHWidget(self.ui.groupBox_view)
+        self.psth.setMaximumHeight(150)
+        self.ui.gridLayout_11.addWidget(self.psth, 2, 0, 1, 1)
+        self.ui.view.absUpdated.connect(self.show_spikes)
+        self.ui.view.polarityInverted.connect(self.show_spikes)
+
+        self.progressBar = QtGui.QProgressBar()
+        self.progressBar.setMaximumWidth(200)
+        self.progressBar.setVisible(False)
+        self.ui.statusbar.addPermanentWidget(self.progressBar)
+
         QtCore.QObject.connect(self.ui.pushButton_browse, QtCore.SIGNAL("clicked()"), self.browse)
         QtCore.QObject.connect(self.ui.comboBox_test_num, QtCore.SIGNAL("currentIndexChanged(const QString&)"), self.load_traces)
         QtCore.QObject.connect(self.ui.comboBox_test_num, QtCore.SIGNAL("currentIndexChanged(const QString&)"), self.load_channels)
         QtCore.QObject.connect(self.ui.comboBox_trace, QtCore.SIGNAL("currentIndexChanged(const QString&)"), self.load_stim_info)
 
         QtCore.QObject.connect(self.ui.pushButton_auto_threshold, QtCore.SIGNAL("clicked()"), self.auto_threshold)
+        self.pushButton_sweep.clicked.connect(self.threshold_sweep)
         QtCore.QObject.connect(self.ui.doubleSpinBox_threshold, QtCore.SIGNAL("valueChanged(const QString&)"), self.update_thresh)
 
         QtCore.QObject.connect(self.ui.comboBox_channel, QtCore.SIGNAL("currentIndexChanged(const QString&)"), self.generate_view)
@@ -53,6 +121,8 @@ class MyForm(QtGui.QMainWindow):
         QtCore.QObject.connect(self.ui.pushButtonGenerate, QtCore.SIGNAL("clicked()"), self.generate_tuning_curve)
 
         QtCore.QObject.connect(self.ui.groupBoxWindow, QtCore.SIGNAL("clicked()"), self.window_check)
+        QtCore.QObject.connect(self.ui.doubleSpinBox_xmin, QtCore.SIGNAL("valueChanged(const QString&)"), self.show_spikes)
+        QtCore.QObject.connect(self.ui.doubleSpinBox_xmax, QtCore.SIGNAL("valueChanged(const QString&)"), self.show_spikes)
 
     def browse(self):
         self.ui.comboBox_test_num.clear()
@@ -73,30 +143,28 @@ class MyForm(QtGui.QMainWindow):
         # If the filename is not blank, attempt to extract test numbers and place them into the combobox
         if self.filename != '':
             if '.hdf5' in self.filename:
+                if self.session is not None:
+                    self.session.close()
+                    self.session = None
                 try:
-                    h_file = h5py.File(unicode(self.filename), 'r')
-                except IOError:
+                    session = DataSession(unicode(self.filename))
+                except (IOError, OSError):
                     self.add_message('Error: I/O Error')
                     return
+                self.session = session
+                self.loader.setFile(self.session.filename)
+                self.spike_memo.clear()
+                self.peak_stats = {}
+                self.shown_trace = None
 
-                tests = {}
-                for key in h_file.keys():
-                    if 'segment' in key:
-                        for test in h_file[key].keys():
-                            tests[test] = int(test.replace('test_', ''))
-
-                sorted_tests = sorted(tests.items(), key=operator.itemgetter(1))
-
-                for test in sorted_tests:
-                    self.ui.comboBox_test_num.addItem(test[0])
+                for test in self.session.tests():
+                    self.ui.comboBox_test_num.addItem(test)
 
                 self.ui.lineEdit_comments.setEnabled(True)
                 self.ui.comboBox_test_num.setEnabled(True)
                 self.ui.comboBox_channel.setEnabled(True)
                 self.ui.comboBox_trace.setEnabled(True)
 
-                h_file.close()
-
                 self.generate_view()
 
             else:
@@ -112,10 +180,18 @@ class MyForm(QtGui.QMainWindow):
         # Validate filename
         if filename != '':
             if '.hdf5' in filename:
+                if self.session is None:
+                    self.add_message('Error: Must select a file to open.')
+                    return False
                 try:
-                    temp_file = h5py.File(unicode(self.filename), 'r')
-                    temp_file.close()
-                except IOError:
+                    # Re-index the file if it changed on disk
+                    if self.session.refresh():
+                        self.add_message('File changed on disk, reloaded ' + str(filename))
+                        self.loader.setFile(self.session.filename)
+                        self.spike_memo.clear()
+                        self.peak_stats = {}
+                        self.shown_trace = None
+                except (IOError, OSError):
                     self.add_message('Error: I/O Error')
                     return False
             else:
@@ -161,13 +237,14 @@ class MyForm(QtGui.QMainWindow):
 
             self.ui.groupBox_contourLvls.setEnabled(False)
 
+        self.show_spikes()
+
     def load_traces(self):
         self.ui.comboBox_trace.clear()
         self.ui.comboBox_trace.setEnabled(False)
 
         if self.valid_filename():
-            h_file = h5py.File(unicode(self.filename), 'r')
-            target_test = self.ui.comboBox_test_num.currentText()
+            target_test = str(self.ui.comboBox_test_num.currentText())
         else:
             self.ui.comboBox_trace.setEnabled(False)
             return
@@ -175,28 +252,17 @@ class MyForm(QtGui.QMainWindow):
         if self.ui.comboBox_test_num.count() == 0:
             self.ui.comboBox_trace.setEnabled(False)
             self.ui.comboBox_trace.clear()
-            h_file.close()
             return
 
-        target_seg = 0
-        for key in h_file.keys():
-            if 'segment' in key:
-                for test in h_file[key].keys():
-                    if target_test == test:
-                        target_seg = key
-                        target_test = test
-
-        traces = h_file[target_seg][target_test].value.shape[0]
+        test_info = self.session.info(target_test)
+        traces = test_info.shape[0]
 
         for i in range(traces):
             self.ui.comboBox_trace.addItem('trace_' + str(i + 1))
 
         self.ui.comboBox_trace.setEnabled(True)
 
-        comment = h_file[target_seg].attrs['comment']
-        self.ui.lineEdit_comments.setText(comment)
-
-        h_file.close()
+        self.ui.lineEdit_comments.setText(test_info.comment)
 
         self.generate_view()
 
@@ -205,29 +271,16 @@ class MyForm(QtGui.QMainWindow):
         self.ui.comboBox_channel.setEnabled(False)
 
         if self.valid_filename():
-            h_file = h5py.File(unicode(self.filename), 'r')
-            target_test = self.ui.comboBox_test_num.currentText()
+            target_test = str(self.ui.comboBox_test_num.currentText())
         else:
             return
 
         if self.ui.comboBox_test_num.count() == 0:
             self.ui.comboBox_trace.setEnabled(False)
             self.ui.comboBox_trace.clear()
-            h_file.close()
             return
 
-        target_seg = 0
-        for key in h_file.keys():
-            if 'segment' in key:
-                for test in h_file[key].keys():
-                    if target_test == test:
-                        target_seg = key
-                        target_test = test
-
-        if len(h_file[target_seg][target_test].value.shape) > 3:
-            channels = h_file[target_seg][target_test].value.shape[2]
-        else:
-            channels = 1
+        channels = num_channels(self.session.dataset(target_test))
 
         if channels == 1:
             self.ui.comboBox_channel.addItem('channel_1')
@@ -240,57 +293,37 @@ class MyForm(QtGui.QMainWindow):
         else:
             self.ui.comboBox_channel.setEnabled(True)
 
-        h_file.close()
-
         self.generate_view()
 
     def load_stim_info(self):
         if self.valid_filename():
-            h_file = h5py.File(unicode(self.filename), 'r')
-            target_test = self.ui.comboBox_test_num.currentText()
+            target_test = str(self.ui.comboBox_test_num.currentText())
         else:
             return
 
-        target_seg = ''
-
-        for key in h_file.keys():
-            if 'segment' in key:
-                for test in h_file[key].keys():
-                    if target_test == test:
-                        target_seg = key
-                        target_test = test
+        if self.ui.comboBox_test_num.count() == 0:
+            return
 
         target_trace = 0
 
         if self.ui.comboBox_trace.currentText() != '':
             target_trace = int(self.ui.comboBox_trace.currentText().replace('trace_', '')) - 1
 
-        stim_info = eval(h_file[target_seg][target_test].attrs['stim'])
-        self.ui.label_stim_type.setText(stim_info[target_trace]['components'][0]['stim_type'])
-        if stim_info[target_trace]['components'][0]['stim_type'] == 'Pure Tone':
-            self.ui.label_frequency.setText(str(int(stim_info[target_trace]['components'][0]['frequency']/1000)) + ' kHz')
+        stim = self.session.stim_table(target_test)
+        self.ui.label_stim_type.setText(stim.stim_type[target_trace])
+        if stim.stim_type[target_trace] == 'Pure Tone':
+            self.ui.label_frequency.setText(str(int(stim.frequency[target_trace]/1000)) + ' kHz')
         else:
             self.ui.label_frequency.setText('')
 
-        h_file.close()
-
     def generate_view(self):
         if self.valid_filename():
-            h_file = h5py.File(unicode(self.filename), 'r')
-            target_test = self.ui.comboBox_test_num.currentText()
+            target_test = str(self.ui.comboBox_test_num.currentText())
         else:
             return
 
-        target_seg = ''
-
-        for key in h_file.keys():
-            if 'segment' in key:
-                for test in h_file[key].keys():
-                    if target_test == test:
-                        target_seg = key
-                        target_test = test
-
-        fs = h_file[target_seg].attrs['samplerate_ad']
+        if self.ui.comboBox_test_num.count() == 0:
+            return
 
         target_trace = []
         target_rep = []
@@ -305,14 +338,35 @@ class MyForm(QtGui.QMainWindow):
         if self.ui.comboBox_channel.currentText() != '':
             target_chan = int(self.ui.comboBox_channel.currentText().replace('channel_', '')) - 1
 
-        test_data = h_file[target_seg][target_test].value
+        test_info = self.session.info(target_test)
+
+        if target_trace == [] or (len(test_info.shape) == 4 and target_chan == []):
+            return
+        if len(test_info.shape) == 3:
+            target_chan = None
+
+        # Read the selected trace of the selected channel in the background, show_trace plots it
+        self.view_request = (target_test, target_trace, target_chan)
+        self.view_rep = target_rep
+        self.loader.request(target_test, target_trace, target_chan, test_info.shape[0])
+
+    def show_trace(self, key, pyramid, rep_stats):
+        # Drop traces that are no longer the one selected
+        if key != self.view_request:
+            return
+
+        if not isinstance(pyramid.data, np.ndarray):
+            # Read full resolution samples through the GUI's own file handle
+            pyramid = MinMaxPyramid(TraceBlock(self.session.dataset(key[0]), key[1], key[2]),
+                                    pyramid.levels, pyramid.factor)
+
+        fs = self.session.info(key[0]).samplerate
+        target_rep = self.view_rep
+
         presentation = []
 
-        # Get the presentation data depending on if there is a channel field or not
-        if len(test_data.shape) == 4:
-            presentation = test_data[target_trace, target_rep, target_chan, :]
-        elif len(test_data.shape) == 3:
-            presentation = test_data[target_trace, target_rep, :]
+        if target_rep != []:
+            presentation = pyramid.data[target_rep, :]
 
         len_presentation = len(presentation)
 
@@ -320,263 +374,336 @@ class MyForm(QtGui.QMainWindow):
         if len_presentation != 0:
             window = len(presentation) / float(fs)
         else:
-            if len(test_data.shape) == 4:
-                window = len(test_data[0, 0, 0, :]) / float(fs)
-                len_presentation = len(test_data[0, 0, 0, :])
-            elif len(test_data.shape) == 3:
-                window = len(test_data[0, 0, :]) / float(fs)
-                len_presentation = len(test_data[0, 0, :])
+            window = pyramid.nsamples / float(fs)
+            len_presentation = pyramid.nsamples
 
         xlist = np.linspace(0, float(window), len_presentation)
         ylist = presentation
 
         # TODO Set window size
         if True:  # not self.ui.checkBox_custom_window.checkState():
-            if len(presentation) > 0:
-                ymin = min(presentation)
-                ymax = max(presentation)
-            else:
-                ymin = 0
-                ymax = 0
-                if len(test_data.shape) == 3:
-                    rep_len = test_data.shape[1]
-                    for i in range(rep_len):
-                        if not test_data[target_trace, i, :].any():
-                            return
-                        if min(test_data[target_trace, i, :]) < ymin:
-                            ymin = min(test_data[target_trace, i, :])
-                        if max(test_data[target_trace, i, :]) > ymax:
-                            ymax = max(test_data[target_trace, i, :])
-                else:
-                    rep_len = test_data.shape[1]
-                    for i in range(rep_len):
-                        if not test_data[target_trace, i, target_chan, :].any():
-                            return
-                        if min(test_data[target_trace, i, target_chan, :]) < ymin:
-                            ymin = min(test_data[target_trace, i, target_chan, :])
-                        if max(test_data[target_trace, i, target_chan, :]) > ymax:
-                            ymax = max(test_data[target_trace, i, target_chan, :])
+            yrange = tracestats.view_range(rep_stats, target_rep if len(presentation) > 0 else None)
+            if yrange is None:
+                return
 
             self.ui.view.setXRange(0, window, 0)
-            self.ui.view.setYRange(ymin, ymax, 0.1)
+            self.ui.view.setYRange(yrange[0], yrange[1], 0.1)
 
         self.ui.view.tracePlot.clear()
-        # Fix xlist to be the length of presentation
-        if len(test_data.shape) == 3:
-            self.ui.view.addTraces(xlist, test_data[target_trace, :, :])
-        else:
-            self.ui.view.addTraces(xlist, test_data[target_trace, :, target_chan, :])
+        self.ui.view.addTraces(xlist, pyramid)
 
-        h_file.close()
+        self.shown_trace = (key, pyramid)
+        self.show_spikes()
 
-    def generate_tuning_curve(self):
-        if self.valid_filename():
-            h_file = h5py.File(unicode(self.filename), 'r')
-            target_test = self.ui.comboBox_test_num.currentText()
-        else:
+    def show_spikes(self, *args):
+        # Ask the loader for the spikes of the shown trace with the current threshold settings
+        if self.shown_trace is None:
+            return
+        (test, trace, chan), _ = self.shown_trace
+        self.spike_request = (test, trace, chan, self.ui.doubleSpinBox_threshold.value(), self.ui.view._abs,
+                              self.ui.view._polarity)
+        self.loader.requestSpikes(*self.spike_request)
+
+    def show_detected_spikes(self, key, spikes):
+        # Drop spikes that are no longer those asked for
+        if key != self.spike_request or self.shown_trace is None:
             return
+        _, pyramid = self.shown_trace
+        fs = spikes.fs
 
-        target_seg = []
-        # Find target segment
-        for segment in h_file.keys():
-            for test in h_file[segment].keys():
-                if target_test == test:
-                    target_seg = segment
-                    target_test = test
+        window = None
+        if self.ui.groupBoxWindow.isChecked():
+            window = (self.ui.doubleSpinBox_xmin.value(), self.ui.doubleSpinBox_xmax.value())
+        spikes = spikes.within(window)
 
-        trace_data = h_file[target_seg][target_test].value
+        self.ui.view.setNreps(len(spikes))
+        self.ui.view.clearData('raster')
+        for rep in range(len(spikes)):
+            self.ui.view.appendData('raster', spikes.train(rep).seconds, [rep])
 
-        fs = h_file[target_seg].attrs['samplerate_ad']
+        nbins = int(np.ceil(pyramid.nsamples / float(fs) / PSTH_BINSZ))
+        self.psth.setBins((np.arange(nbins) + 0.5) * PSTH_BINSZ)
+        if len(spikes.samples) > 0:
+            self.psth.appendData(spikestats.bin_spikes(spikes.samples / float(fs), PSTH_BINSZ))
 
-        samples = trace_data.shape[-1]
-        traces = trace_data.shape[0]
-        reps = trace_data.shape[1]
+    def trace_load_failed(self, key, error):
+        self.add_message('Error: could not read ' + key[0] + ' trace ' + str(key[1] + 1) + ': ' + error)
+
+    def generate_tuning_curve(self):
+        # The generate button cancels a tuning curve in progress
+        if self.tuning_worker is not None:
+            self.tuning_worker.cancel()
+            return
 
-        if len(h_file[target_seg][target_test].value.shape) > 3:
-            channels = h_file[target_seg][target_test].value.shape[2]
+        if self.valid_filename():
+            target_test = str(self.ui.comboBox_test_num.currentText())
         else:
-            channels = 1
+            return
 
-        stim_info = eval(h_file[target_seg][target_test].attrs['stim'])
+        channels = num_channels(self.session.dataset(target_test))
 
         # Get the values from the combo boxes
-        if self.ui.comboBox_trace.currentText() != '':
-            target_trace = int(self.ui.comboBox_trace.currentText().replace('trace_', '')) - 1
+        target_chan = None
         if self.ui.comboBox_channel.currentText() != '':
             target_chan = int(self.ui.comboBox_channel.currentText().replace('channel_', '')) - 1
 
         # Get the values from the spinbox
         thresh = self.ui.doubleSpinBox_threshold.value()
 
-        # print 'test:', target_test
-        # print 'trace:', target_trace
-        # print 'chan:', target_chan
-        # print ''
-
-        frequency = []
-        intensity = []
-        spike_count = {}
-
-        if len(trace_data.shape) == 4:
-            for t in range(traces):
-                # print 'trace:', t
-                # print 'stim_type:', stim_info[t]['components'][0]['stim_type']
-                # print 'intensity:', stim_info[t]['components'][0]['intensity']
-                # if stim_info[t]['components'][0]['stim_type'] != 'silence':
-                #     print 'frequency:', stim_info[t]['components'][0]['frequency']
-
-                if stim_info[t]['components'][0]['stim_type'] != 'silence':
-                    intensity.append(stim_info[t]['components'][0]['intensity'])
-                    frequency.append(stim_info[t]['components'][0]['frequency']/1000)
-
-                    spikes = 0
-                    for r in range(reps):
-                        if self.ui.groupBoxWindow.isChecked():
-                            x_min = np.floor(self.ui.doubleSpinBox_xmin.value() * fs)
-                            x_max = np.floor(self.ui.doubleSpinBox_xmax.value() * fs)
-
-                            temp_trace = trace_data[t][r][target_chan]
-                            trace = temp_trace[x_min:x_max]
-                            pass
-                        else:
-                            trace = trace_data[t][r][target_chan]
-
-                        spike_times = 1000 * np.array(get_spike_times(trace, thresh, fs, self.ui.view._abs))
-                        spikes += len(spike_times)
-
-                    spike_count[(stim_info[t]['components'][0]['frequency']/1000, stim_info[t]['components'][0]['intensity'])] = float(spikes)/float(reps)
-                    # print 'spikes:', float(spikes)
-                    # print 'avg_spikes:', float(spikes)/float(reps)
-
-        if len(trace_data.shape) == 3:
-            for t in range(traces):
-
-                if stim_info[t]['components'][0]['stim_type'] != 'silence':
-                    intensity.append(stim_info[t]['components'][0]['intensity'])
-                    frequency.append(stim_info[t]['components'][0]['frequency']/1000)
-
-                spikes = 0
-                for r in range(reps):
-                    trace = trace_data[t][r]
-
-                    spike_times = 1000 * np.array(get_spike_times(trace, thresh, fs, self.ui.view._abs))
-                    spikes += len(spike_times)
-
-                if stim_info[t]['components'][0]['stim_type'] != 'silence':
-                    spike_count[(stim_info[t]['components'][0]['frequency']/1000, stim_info[t]['components'][0]['intensity'])] = float(spikes)/float(reps)
-
-        # Get only the unique values
-        frequency = sorted(list(set(frequency)))
-        intensity = sorted(list(set(intensity)))
-
-        # print 'freq', len(frequency), frequency
-        # print 'inten', len(intensity), intensity
-
-        xlist = np.linspace(min(frequency), max(frequency), len(frequency))
-        ylist = np.linspace(min(intensity), max(intensity), len(intensity))
-
-        # print 'xlist', len(xlist), xlist
-        # print 'ylist', len(ylist), ylist
-
-        # Initialize Z
-        Z = np.empty([len(intensity), len(frequency)])
-
-        X, Y = np.meshgrid(xlist, ylist)
-        for y in range(len(intensity)):
-            for x in range(len(frequency)):
-                Z[y][x] = spike_count[(frequency[x], intensity[y])]
-                # print '(y, x):', y, x
-                # print 'freq:', frequency[x]
-                # print 'inten:', intensity[y]
-
-
-        plt.figure()
-
+        window = None
+        levels = None
         if self.ui.groupBoxWindow.isChecked():
+            window = (self.ui.doubleSpinBox_xmin.value(), self.ui.doubleSpinBox_xmax.value())
             # Set the min, max and number of contour levels
-            levels = np.linspace(self.ui.doubleSpinBox_zmin.value(), self.ui.doubleSpinBox_zmax.value(), num=(self.ui.spinBoxContourLevels.value()+1))
-            cp = plt.contourf(X, Y, Z, levels)
-        else:
-            # Auto assign contour levels
-            cp = plt.contourf(X, Y, Z)
-
-        plt.colorbar(cp, label='Mean Spikes Per Presentation')
-
-        # print 'X:', X
-        # print 'Y:', Y
-        # print 'Z:', Z
+            levels = tuning.contour_levels(self.ui.doubleSpinBox_zmin.value(), self.ui.doubleSpinBox_zmax.value(),
+                                           self.ui.spinBoxContourLevels.value())
 
-        # plt.title('Tuning Curve')
         if channels == 1:
-            plt.title(str.split(str(self.filename), '/')[-1].replace('.hdf5', '') + ' ' + str(
-                self.ui.comboBox_test_num.currentText()).replace('test_', 'Test '))
+            title = str.split(str(self.filename), '/')[-1].replace('.hdf5', '') + ' ' + str(
+                self.ui.comboBox_test_num.currentText()).replace('test_', 'Test ')
         else:
-            plt.title(str.split(str(self.filename), '/')[-1].replace('.hdf5', '') + ' ' + str(
+            title = str.split(str(self.filename), '/')[-1].replace('.hdf5', '') + ' ' + str(
                 self.ui.comboBox_test_num.currentText()).replace('test_', 'Test ') + ' ' + str(
-                self.ui.comboBox_channel.currentText()).replace('channel_', 'Channel '))
-        plt.xlabel('Frequency (kHz)')
-        # plt.xlabel('Frequency (Hz)')
-        plt.ylabel('Intensity (dB)')
-        plt.figtext(.02, .02, 'Threshold: ' + str(self.ui.doubleSpinBox_threshold.value()) + ' V')
+                self.ui.comboBox_channel.currentText()).replace('channel_', 'Channel ')
+        self.tuning_plot = (title, thresh, levels)
+
+        # Compute on a worker thread, plotting when the result comes back
+        self.tuning_thread = QtCore.QThread()
+        self.tuning_worker = TuningCurveWorker(self.session.filename, target_test, thresh, target_chan, window,
+                                               self.ui.view._abs, self.ui.view._polarity, store=default_path(),
+                                               memo=self.spike_memo)
+        self.tuning_worker.moveToThread(self.tuning_thread)
+        self.tuning_thread.started.connect(self.tuning_worker.run)
+        self.tuning_worker.progress.connect(self.tuning_progress)
+        self.tuning_worker.finished.connect(self.tuning_finished)
+        self.tuning_worker.failed.connect(self.tuning_failed)
+        self.tuning_worker.cancelled.connect(self.tuning_cancelled)
+        self.tuning_worker.done.connect(self.tuning_done)
+
+        self.progressBar.setValue(0)
+        self.progressBar.setVisible(True)
+        self.ui.pushButtonGenerate.setText('Cancel')
+        self.lock_workers(True, self.ui.pushButtonGenerate)
+        self.add_message('Generating tuning curve: ' + title)
+        self.tuning_thread.start()
+
+    def lock_workers(self, running, cancel=None):
+        # The workers share the progress bar, so only one runs at a time. While one
+        # runs the buttons that start the others are disabled, except its own cancel button
+        for button in (self.ui.pushButtonGenerate, self.pushButton_sweep, self.ui.pushButton_auto_threshold):
+            button.setEnabled(not running or button is cancel)
+
+    def tuning_progress(self, ndone, total):
+        self.progressBar.setMaximum(total)
+        self.progressBar.setValue(ndone)
+        self.ui.statusbar.showMessage('Detecting spikes: trace ' + str(ndone) + ' of ' + str(total))
+
+    def tuning_finished(self, curve):
+        self.tuning_result = curve
+
+    def tuning_failed(self, error):
+        self.add_message('Error: tuning curve failed\n' + error)
+
+    def tuning_cancelled(self):
+        self.add_message('Tuning curve cancelled')
+
+    def tuning_done(self):
+        self.tuning_thread.quit()
+        self.tuning_thread.wait()
+        stored = self.tuning_worker.stored
+        memoized = self.tuning_worker.memoized
+        self.tuning_thread = None
+        self.tuning_worker = None
+        self.progressBar.setVisible(False)
+        self.ui.statusbar.clearMessage()
+        self.ui.pushButtonGenerate.setText('Generate Plot')
+        self.lock_workers(False)
+
+        if self.tuning_result is not None:
+            curve = self.tuning_result
+            self.tuning_result = None
+            title, thresh, levels = self.tuning_plot
+            if memoized:
+                self.add_message('Tuning curve done: ' + title + ' (spikes from this session)')
+            elif stored:
+                self.add_message('Tuning curve done: ' + title + ' (spikes from a previous detection)')
+            else:
+                self.add_message('Tuning curve done: ' + title)
+            self.add_message(self.spike_memo.summary())
+            tuning.draw(plt.figure(), curve, title, thresh, levels)
+            plt.show()
+
+    def threshold_sweep(self):
+        # The sweep button cancels a sweep in progress
+        if self.sweep_worker is not None:
+            self.sweep_worker.cancel()
+            return
 
-        # Idea to try interpolation, didn't work as intended
-        # plt.imshow(Z, aspect='equal', interpolation=None, origin='lower')
+        if self.valid_filename():
+            target_test = str(self.ui.comboBox_test_num.currentText())
+        else:
+            return
 
-        plt.show()
+        dset = self.session.dataset(target_test)
+        target_chan = None
+        if len(dset.shape) == 4:
+            target_chan = int(self.ui.comboBox_channel.currentText().replace('channel_', '')) - 1
 
-    def auto_threshold(self):
-        thresh_fraction = 0.7
+        window = None
+        if self.ui.groupBoxWindow.isChecked():
+            window = (self.ui.doubleSpinBox_xmin.value(), self.ui.doubleSpinBox_xmax.value())
+
+        self.sweep_title = str.split(str(self.filename), '/')[-1].replace('.hdf5', '') + ' ' + target_test.replace(
+            'test_', 'Test ')
+        if target_chan is not None:
+            self.sweep_title += ' Channel ' + str(target_chan + 1)
+
+        self.sweep_thread = QtCore.QThread()
+        self.sweep_worker = ThresholdSweepWorker(self.session.filename, target_test, self.selected_trace(),
+                                                 channel=target_chan, window=window, absval=self.ui.view._abs,
+                                                 polarity=self.ui.view._polarity)
+        self.sweep_worker.moveToThread(self.sweep_thread)
+        self.sweep_thread.started.connect(self.sweep_worker.run)
+        self.sweep_worker.progress.connect(self.tuning_progress)
+        self.sweep_worker.finished.connect(self.sweep_finished)
+        self.sweep_worker.failed.connect(self.sweep_failed)
+        self.sweep_worker.cancelled.connect(self.sweep_cancelled)
+        self.sweep_worker.done.connect(self.sweep_done)
+
+        self.progressBar.setValue(0)
+        self.progressBar.setVisible(True)
+        self.pushButton_sweep.setText('Cancel')
+        self.lock_workers(True, self.pushButton_sweep)
+        self.add_message('Sweeping thresholds: ' + self.sweep_title)
+        self.sweep_thread.start()
+
+    def sweep_finished(self, result):
+        self.sweep_result = result
+
+    def sweep_failed(self, error):
+        self.add_message('Error: threshold sweep failed\n' + error)
+
+    def sweep_cancelled(self):
+        self.add_message('Threshold sweep cancelled')
+
+    def sweep_done(self):
+        self.sweep_thread.quit()
+        self.sweep_thread.wait()
+        self.sweep_thread = None
+        self.sweep_worker = None
+        self.progressBar.setVisible(False)
+        self.ui.statusbar.clearMessage()
+        self.pushButton_sweep.setText('Sweep')
+        self.lock_workers(False)
+
+        if self.sweep_result is not None:
+            thresholds, counts, stim = self.sweep_result
+            self.sweep_result = None
+            self.add_message('Threshold sweep done: ' + self.sweep_title)
+            tuning.draw_sweep(plt.figure(), thresholds, counts, stim, self.sweep_title,
+                              self.ui.doubleSpinBox_threshold.value())
+            plt.show()
 
+    def auto_threshold(self):
         if self.valid_filename():
-            h_file = h5py.File(unicode(self.filename), 'r')
-            target_test = self.ui.comboBox_test_num.currentText()
+            target_test = str(self.ui.comboBox_test_num.currentText())
         else:
             return
 
-        # Find target segment
-        target_seg = []
-        for segment in h_file.keys():
-            for test in h_file[segment].keys():
-                if target_test == test:
-                    target_seg = segment
-                    target_test = test
-
-        trace_data = h_file[target_seg][target_test].value
+        # the noise methods need sketches of the signal, which take longer to compute
+        sketches = THRESHOLD_METHODS[self.comboBox_threshold_method.currentIndex()] != 'peak'
+        stats = self.peak_stats.get(target_test)
+        if stats is not None and (stats.sketches is not None or not sketches):
+            self.apply_auto_threshold(target_test)
+            return
+        if self.stats_worker is not None:
+            return
 
-        if len(trace_data.shape) == 4:
+        # Compute the statistics of every channel of the test once, on a worker thread
+        self.stats_thread = QtCore.QThread()
+        self.stats_worker = PeakStatsWorker(self.session.filename, target_test, sketches)
+        self.stats_worker.moveToThread(self.stats_thread)
+        self.stats_thread.started.connect(self.stats_worker.run)
+        self.stats_worker.progress.connect(self.tuning_progress)
+        self.stats_worker.finished.connect(self.stats_finished)
+        self.stats_worker.failed.connect(self.stats_failed)
+        self.stats_worker.done.connect(self.stats_done)
+
+        self.progressBar.setValue(0)
+        self.progressBar.setVisible(True)
+        self.lock_workers(True)
+        self.stats_thread.start()
+
+    def stats_finished(self, stats):
+        self.peak_stats[self.stats_worker.test] = stats
+
+    def stats_failed(self, error):
+        self.add_message('Error: auto threshold failed\n' + error)
+
+    def stats_done(self):
+        test = self.stats_worker.test
+        self.stats_thread.quit()
+        self.stats_thread.wait()
+        self.stats_thread = None
+        self.stats_worker = None
+        self.progressBar.setVisible(False)
+        self.ui.statusbar.clearMessage()
+        self.lock_workers(False)
+
+        if test in self.peak_stats and str(self.ui.comboBox_test_num.currentText()) == test:
+            # the method may have changed meanwhile; this computes sketches if it needs them
+            self.auto_threshold()
+
+    def apply_auto_threshold(self, test):
+        stats = self.peak_stats[test]
+        target_chan = None
+        if len(self.session.info(test).shape) == 4:
             target_chan = int(self.ui.comboBox_channel.currentText().replace('channel_', '')) - 1
 
-            # Compute threshold from average maximum of traces
-            max_trace = []
-            for n in range(len(trace_data[1, :, target_chan, 0])):
-                max_trace.append(np.max(np.abs(trace_data[1, n, target_chan, :])))
-            average_max = np.array(max_trace).mean()
-            thresh = thresh_fraction * average_max
-
-            # self.add_message(trace_data.shape)
-
-        elif len(trace_data.shape) == 3:
-            # Compute threshold from average maximum of traces
-            max_trace = []
-            for n in range(len(trace_data[1, :, 0])):
-                max_trace.append(np.max(np.abs(trace_data[1, n, :])))
-            average_max = np.array(max_trace).mean()
-            thresh = thresh_fraction * average_max
-
-            # self.add_message(trace_data.shape)
+        method = THRESHOLD_METHODS[self.comboBox_threshold_method.currentIndex()]
+        if method == 'peak':
+            # average maximum of the reps of the selected trace
+            thresh = stats.threshold(method, target_chan, trace=self.selected_trace())
+        else:
+            thresh = stats.threshold(method, target_chan)
 
         self.ui.doubleSpinBox_threshold.setValue(thresh)
         self.update_thresh()
 
-        h_file.close()
+    def selected_trace(self):
+        # Index of the trace selected in the view, or None
+        if self.ui.comboBox_trace.currentText() == '':
+            return None
+        return int(self.ui.comboBox_trace.currentText().replace('trace_', '')) - 1
 
     def update_thresh(self):
         self.ui.view.setThreshold(self.ui.doubleSpinBox_threshold.value())
         self.ui.view.update_thresh()
+        self.show_spikes()
 
     def update_thresh2(self):
         self.ui.doubleSpinBox_threshold.setValue(self.ui.view.getThreshold())
 
+    def stop_worker(self, worker, thread, done):
+        # Cancel a running worker and wait for its thread to finish, without handling its results
+        if worker is None:
+            return
+        worker.done.disconnect(done)
+        worker.cancel()
+        thread.quit()
+        thread.wait()
+
+    def closeEvent(self, event):
+        self.stop_worker(self.tuning_worker, self.tuning_thread, self.tuning_done)
+        self.stop_worker(self.sweep_worker, self.sweep_thread, self.sweep_done)
+        self.stop_worker(self.stats_worker, self.stats_thread, self.stats_done)
+        self.tuning_worker = self.sweep_worker = self.stats_worker = None
+        self.tuning_thread = self.sweep_thread = self.stats_thread = None
+        self.loader.stop()
+        if self.session is not None:
+            self.session.close()
+        super(MyForm, self).closeEvent(event)
+
     def add_message(self, message):
         self.message_num += 1
         self.ui.textEdit.append('[' + str(self.message_num) + ']: ' + message + '\n')
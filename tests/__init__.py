@@ -0,0 +1,9 @@
+"""Tests of the util modules
+
+The util modules import each other by name, as the application runs them, so
+the util directory is put on the path for them.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'util'))
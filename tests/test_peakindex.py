@@ -0,0 +1,56 @@
+"""Checks spikes found from a peak index against detection on the samples"""
+import unittest
+
+import numpy as np
+
+from util import peakindex, spikestats
+
+FS = 50000.0
+
+
+class PeakIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.rng = np.random.RandomState(2)
+
+    def check(self, block, thresholds, fs=FS):
+        for absval in (True, False):
+            for polarity in (1, -1):
+                index = peakindex.PeakIndex.from_block(block, fs, absval, polarity)
+                signal = block if absval else block * polarity
+                for threshold in thresholds:
+                    samples, offsets, _ = spikestats.batch_spike_samples(signal, threshold, fs, absval)
+                    found, found_offsets = index.spike_samples(threshold)
+                    np.testing.assert_array_equal(found, samples)
+                    np.testing.assert_array_equal(found_offsets, offsets)
+                    np.testing.assert_array_equal(index.counts(threshold), np.diff(offsets))
+
+    def test_noise(self):
+        for nsamples in (5, 50, 400):
+            self.check(self.rng.normal(0, 1, (4, nsamples)), np.linspace(-1, 3, 9))
+
+    def test_ties(self):
+        # equal samples within a run, and runs that are flat at their maximum
+        self.check(np.round(self.rng.normal(0, 1, (4, 300)), 1), [0.0, 0.5, 1.0, 1.5])
+        self.check(self.rng.randint(-3, 4, (3, 200)).astype(np.float32), [-1, 0, 0.5, 1, 2])
+
+    def test_long_runs(self):
+        # runs much longer than a spike, whose maximum is often their last sample
+        self.check(np.cumsum(self.rng.normal(0, 1, (4, 500)), axis=1), np.linspace(-5, 20, 11), fs=1000.0)
+
+    def test_spikes(self):
+        block = self.rng.normal(0, 0.2, (5, 2000))
+        at = self.rng.randint(0, 2000, (5, 20))
+        block[np.arange(5)[:, None], at] += self.rng.choice([-1, 1], (5, 20)) * self.rng.uniform(0.5, 2, (5, 20))
+        block[:, :2] = 1.2
+        block[:, -1] = -1.5
+        self.check(block, [0.3, 0.5, 0.8, 1.0, 1.9])
+
+    def test_above_every_peak(self):
+        index = peakindex.PeakIndex.from_block(self.rng.normal(0, 1, (3, 100)), FS)
+        samples, offsets = index.spike_samples(100.0)
+        self.assertEqual(len(samples), 0)
+        np.testing.assert_array_equal(offsets, np.zeros(4))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,155 @@
+"""Checks the vectorized spike detection and refractory period against the per recording references"""
+import unittest
+
+import numpy as np
+
+from util import spikestats
+
+FS = 50000.0
+
+
+def random_block(rng, shape, nspikes=20):
+    """Noise with spikes of both signs, some of them touching the ends of the recordings"""
+    block = rng.normal(0, 0.2, shape)
+    rows = block.reshape(-1, shape[-1])
+    for row in rows:
+        at = rng.randint(0, shape[-1], nspikes)
+        row[at] += rng.choice([-1, 1], nspikes) * rng.uniform(0.5, 2, nspikes)
+        row[at[at < shape[-1] - 1] + 1] += 0.6 * np.sign(row[at[at < shape[-1] - 1]])
+    rows[::3, 0] = 1.5
+    rows[::4, -1] = -1.5
+    rows[1::5, -2:] = 1.2
+    return block
+
+
+def greedy_refractory(times, refract=0.002, fs=None):
+    """Reference refractory period: keeps a spike if it is at least refract after the last kept one
+
+    Sample indices are compared in seconds, as get_spike_times always did"""
+    seconds = [time / float(fs) if fs else time for time in times]
+    kept = []
+    for itime in range(len(times)):
+        if len(kept) == 0 or seconds[kept[-1]] + refract <= seconds[itime]:
+            kept.append(itime)
+    return [times[itime] for itime in kept]
+
+
+class BatchSpikeSamplesTest(unittest.TestCase):
+    def setUp(self):
+        self.rng = np.random.RandomState(0)
+
+    def check(self, block, threshold, absval=True, channel=None):
+        samples, offsets, shape = spikestats.batch_spike_samples(block, threshold, FS, absval, channel)
+        if channel is not None:
+            block = block[:, :, channel, :]
+        self.assertEqual(shape, block.shape[:-1])
+        rows = block.reshape(-1, block.shape[-1])
+        self.assertEqual(len(offsets), len(rows) + 1)
+        for irow, row in enumerate(rows):
+            expected = spikestats.get_spike_times(row, threshold, FS, absval, as_train=True).samples
+            np.testing.assert_array_equal(samples[offsets[irow]:offsets[irow + 1]], expected)
+
+    def test_matches_get_spike_times(self):
+        for threshold in (0.3, 0.5, 1.0, 3.0):
+            for absval in (True, False):
+                self.check(random_block(self.rng, (4, 5, 600)), threshold, absval)
+
+    def test_dense_crossings(self):
+        # low thresholds give many short runs, including single and two point ones
+        block = self.rng.normal(0, 1, (3, 4, 300))
+        for threshold in (0.0, 0.5, 1.5):
+            self.check(block, threshold)
+
+    def test_channel(self):
+        block = random_block(self.rng, (3, 2, 3, 400))
+        for channel in range(3):
+            self.check(block, 0.5, channel=channel)
+
+    def test_blocks_of_rows(self):
+        block = random_block(self.rng, (6, 5, 200))
+        default = spikestats.BATCH_SAMPLES
+        spikestats.BATCH_SAMPLES = 3 * 200
+        try:
+            self.check(block, 0.5)
+        finally:
+            spikestats.BATCH_SAMPLES = default
+
+    def test_batch_spike_times(self):
+        block = random_block(self.rng, (3, 4, 500))
+        counts, trains = spikestats.batch_spike_times(block, 0.5, FS)
+        self.assertEqual(counts.shape, (3, 4))
+        for index in np.ndindex(3, 4):
+            expected = spikestats.get_spike_times(block[index], 0.5, FS)
+            self.assertEqual(counts[index], len(expected))
+            np.testing.assert_array_equal(trains[index].seconds, expected)
+
+    def test_no_spikes(self):
+        samples, offsets, shape = spikestats.batch_spike_samples(np.zeros((2, 3, 100)), 1.0, FS)
+        self.assertEqual(len(samples), 0)
+        np.testing.assert_array_equal(offsets, np.zeros(7))
+        self.assertEqual(shape, (2, 3))
+
+
+class BatchRefractoryTest(unittest.TestCase):
+    def setUp(self):
+        self.rng = np.random.RandomState(1)
+
+    def random_trains(self, ntrains, nsamples=2000, dense=False):
+        trains = []
+        for _ in range(ntrains):
+            count = self.rng.randint(0, 200 if dense else 30)
+            trains.append(np.sort(self.rng.choice(nsamples, count, replace=False)))
+        return trains
+
+    def check(self, trains, refract, fs=None):
+        offsets = np.concatenate([[0], np.cumsum([len(train) for train in trains])])
+        times = np.concatenate(trains) if len(trains) > 0 else np.zeros(0)
+        kept, kept_offsets = spikestats.batch_refractory(times, offsets, refract, fs)
+        self.assertEqual(len(kept_offsets), len(trains) + 1)
+        self.assertEqual(kept_offsets[-1], len(kept))
+        for itrain, train in enumerate(trains):
+            expected = greedy_refractory(train, refract, fs)
+            np.testing.assert_array_equal(kept[kept_offsets[itrain]:kept_offsets[itrain + 1]], expected)
+
+    def test_samples(self):
+        for dense in (False, True):
+            for refract in (0.0001, 0.002, 0.01):
+                self.check(self.random_trains(20, dense=dense), refract, FS)
+
+    def test_seconds(self):
+        trains = [train / FS for train in self.random_trains(20, dense=True)]
+        for refract in (0.0005, 0.002):
+            self.check(trains, refract)
+
+    def test_bursts(self):
+        # runs of spikes closer than the period, where only every other one or fewer is kept
+        trains = [np.arange(0, 500, step) for step in (1, 10, 60, 99, 100, 101)]
+        self.check(trains, 0.002, FS)
+        self.check(trains + [np.zeros(0, dtype=int)] * 3, 0.002, FS)
+
+    def test_refractory(self):
+        for train in self.random_trains(10, dense=True):
+            np.testing.assert_array_equal(spikestats.refractory(train, fs=FS), greedy_refractory(train, fs=FS))
+        self.assertEqual(len(spikestats.refractory([], fs=FS)), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+
+class QuantileSketchTest(unittest.TestCase):
+    def test_quantile(self):
+        rng = np.random.RandomState(0)
+        values = np.concatenate([rng.normal(0, 0.1, 20000), rng.normal(0, 5, 50), np.zeros(100)])
+        sketch = spikestats.QuantileSketch(accuracy=0.01)
+        for block in np.array_split(values, 7):
+            sketch.update(block)
+        self.assertEqual(sketch.count, len(values))
+        ordered = np.sort(np.abs(values))
+        for q in (0.0, 0.001, 0.25, 0.5, 0.9, 0.999, 1.0):
+            # the value at rank q * (count - 1), within the accuracy
+            expected = ordered[int(np.floor(q * (len(values) - 1)))]
+            self.assertLessEqual(abs(sketch.quantile(q) - expected), 0.01 * expected)
+
+    def test_empty(self):
+        self.assertTrue(np.isnan(spikestats.QuantileSketch().quantile(0.5)))
@@ -0,0 +1,96 @@
+"""Checks the vectorized tuning grid and cell statistics against loops over the presentations"""
+import unittest
+
+import numpy as np
+
+from util import tuning
+
+
+def random_presentations(rng, ntraces=40, nreps=5):
+    """Traces on a small grid, with repeated stimuli, traces without a frequency and reps without spikes"""
+    frequency = rng.choice([5000.0, 10000.0, 20000.0, 40000.0], ntraces)
+    intensity = rng.choice([20.0, 40.0, 60.0], ntraces)
+    frequency[::7] = np.nan
+    intensity[3::11] = np.nan
+    counts = rng.poisson(1.0, (ntraces, nreps))
+    latency = np.where(counts > 0, rng.uniform(0.005, 0.05, (ntraces, nreps)), np.nan)
+    return frequency, intensity, counts, latency
+
+
+def loop_cells(frequency, intensity, counts, latency):
+    """Presentations of each (intensity, frequency) cell, as lists of (count, latency) in trace then rep order"""
+    valid = [itrace for itrace in range(len(frequency))
+             if not np.isnan(frequency[itrace]) and not np.isnan(intensity[itrace])]
+    frequencies = sorted(set(frequency[valid]))
+    intensities = sorted(set(intensity[valid]))
+    cells = {}
+    for itrace in valid:
+        key = (intensities.index(intensity[itrace]), frequencies.index(frequency[itrace]))
+        for irep in range(counts.shape[1]):
+            cells.setdefault(key, []).append((counts[itrace, irep], latency[itrace, irep]))
+    return frequencies, intensities, cells
+
+
+class TuningGridTest(unittest.TestCase):
+    def setUp(self):
+        self.rng = np.random.RandomState(0)
+
+    def test_tuning_grid(self):
+        frequency, intensity, counts, latency = random_presentations(self.rng)
+        grid_frequency, grid_intensity, spikes, presentations = tuning.tuning_grid(frequency, intensity, counts)
+        frequencies, intensities, cells = loop_cells(frequency, intensity, counts, latency)
+        np.testing.assert_array_equal(grid_frequency, frequencies)
+        np.testing.assert_array_equal(grid_intensity, intensities)
+        for iy in range(len(intensities)):
+            for ix in range(len(frequencies)):
+                cell = cells.get((iy, ix), [])
+                self.assertEqual(spikes[iy, ix], sum(count for count, _ in cell))
+                self.assertEqual(presentations[iy, ix], len(cell))
+
+    def test_cell_stats(self):
+        frequency, intensity, counts, latency = random_presentations(self.rng)
+        # a cell whose presentations have no spikes has no latency
+        counts[(frequency == 40000.0) & (intensity == 60.0)] = 0
+        latency[counts == 0] = np.nan
+        valid, grid_frequency, grid_intensity, cell = tuning._grid_cells(frequency, intensity)
+        shape = (len(grid_intensity), len(grid_frequency))
+        stats = tuning.cell_stats(cell, shape, counts[valid], latency[valid])
+        frequencies, intensities, cells = loop_cells(frequency, intensity, counts, latency)
+        self.assertEqual(stats.shape, (len(intensities), len(frequencies)))
+        for iy in range(len(intensities)):
+            for ix in range(len(frequencies)):
+                presented = cells.get((iy, ix), [])
+                cell_counts = np.array([count for count, _ in presented], dtype=float)
+                latencies = [lat for _, lat in presented if not np.isnan(lat)]
+                stat = stats[iy, ix]
+                self.assertEqual(stat['count'], len(presented))
+                rep_counts = list(stat['rep_counts'])
+                self.assertEqual(rep_counts[:len(presented)], [int(count) for count in cell_counts])
+                self.assertTrue(all(count == -1 for count in rep_counts[len(presented):]))
+                if presented:
+                    self.assertAlmostEqual(stat['mean'], cell_counts.mean())
+                else:
+                    self.assertTrue(np.isnan(stat['mean']))
+                if len(presented) > 1:
+                    self.assertAlmostEqual(stat['var'], cell_counts.var(ddof=1))
+                    self.assertAlmostEqual(stat['sem'], np.sqrt(cell_counts.var(ddof=1) / len(presented)))
+                else:
+                    self.assertTrue(np.isnan(stat['var']))
+                if latencies:
+                    self.assertAlmostEqual(stat['latency'], np.median(latencies))
+                else:
+                    self.assertTrue(np.isnan(stat['latency']))
+
+    def test_small_cells(self):
+        # one presentation, two with a rep without spikes, and none
+        stats = tuning.cell_stats(np.array([0, 1, 1]), (1, 3), np.array([[3], [0], [2]]),
+                                  np.array([[0.01], [np.nan], [0.02]]))
+        self.assertEqual(list(stats['count'][0]), [1, 2, 0])
+        self.assertAlmostEqual(stats['mean'][0, 0], 3.0)
+        self.assertTrue(np.isnan(stats['var'][0, 0]))
+        self.assertAlmostEqual(stats['var'][0, 1], 2.0)
+        self.assertTrue(np.isnan(stats['mean'][0, 2]))
+        self.assertEqual([list(counts) for counts in stats['rep_counts'][0]], [[3, -1], [0, 2], [-1, -1]])
+        self.assertAlmostEqual(stats['latency'][0, 0], 0.01)
+        self.assertAlmostEqual(stats['latency'][0, 1], 0.02)
+        self.assertTrue(np.isnan(stats['latency'][0, 2]))
@@ -0,0 +1,200 @@
+"""Access to Sparkle test datasets that reads only the part of a test needed
+
+Test datasets are of dimensions (trace, rep, samples), or (trace, rep, channel, samples)
+for multi-channel recordings. The functions here work from the dataset shape and
+read hyperslabs, so a test is never loaded into memory all at once.
+"""
+import collections
+import os
+
+import h5py
+import numpy as np
+
+from stiminfo import StimTable
+
+# default upper bound on the size of a block returned by iter_chunks
+CHUNK_BYTES = 64 * 2 ** 20
+
+
+def num_channels(dset):
+    """Number of recording channels in a test dataset
+
+    :param dset: test dataset
+    :type dset: h5py.Dataset
+    :returns: int
+    """
+    if len(dset.shape) > 3:
+        return dset.shape[2]
+    return 1
+
+
+def read_block(dset, traces=slice(None), reps=slice(None), channel=None, window=None):
+    """Reads part of a test dataset
+
+    :param dset: test dataset
+    :type dset: h5py.Dataset
+    :param traces: trace index or slice of traces to read
+    :type traces: int or slice
+    :param reps: rep index or slice of reps to read
+    :type reps: int or slice
+    :param channel: channel to read, for multi-channel tests. If None, all channels are kept.
+    :type channel: int
+    :param window: (start, stop) sample indices to read. If None, reads the whole recording.
+    :type window: (int, int)
+    :returns: numpy array -- the data, with the channel axis removed if a channel is given
+    """
+    if window is None:
+        samples = slice(None)
+    else:
+        samples = slice(int(window[0]), int(window[1]))
+
+    if len(dset.shape) == 4:
+        if channel is None:
+            channel = slice(None)
+        return dset[traces, reps, channel, samples]
+    return dset[traces, reps, samples]
+
+
+class TraceBlock(object):
+    """The reps of one trace of a test, read from the dataset only when indexed
+
+    Indexing with (reps, samples), where samples is a slice without a step,
+    reads just that part, e.g. block[:, 1000:2000].
+
+    :param dset: test dataset
+    :type dset: h5py.Dataset
+    :param trace: trace index
+    :type trace: int
+    :param channel: channel to read, for multi-channel tests
+    :type channel: int
+    """
+    def __init__(self, dset, trace, channel=None):
+        self.dset = dset
+        self.trace = trace
+        self.channel = channel
+        self.shape = (dset.shape[1], dset.shape[-1])
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key, slice(None))
+        reps, samples = key
+        start, stop, _ = samples.indices(self.shape[1])
+        return read_block(self.dset, self.trace, reps, self.channel, window=(start, stop))
+
+
+def iter_chunks(dset, channel=None, window=None, max_bytes=CHUNK_BYTES):
+    """Iterates through a test dataset in blocks of whole traces
+
+    :param dset: test dataset
+    :type dset: h5py.Dataset
+    :param channel: channel to read, for multi-channel tests
+    :type channel: int
+    :param window: (start, stop) sample indices to read
+    :type window: (int, int)
+    :param max_bytes: upper bound on the size of each block (a block holds at least one trace)
+    :type max_bytes: int
+    :returns: generator of (start, stop, block) -- the traces start:stop and their data, as read by read_block
+    """
+    ntraces = dset.shape[0]
+    trace_bytes = np.prod(dset.shape[1:]) * dset.dtype.itemsize
+    if channel is not None and len(dset.shape) == 4:
+        trace_bytes = trace_bytes // dset.shape[2]
+    if window is not None:
+        trace_bytes = trace_bytes * max(0, int(window[1]) - int(window[0])) // max(dset.shape[-1], 1)
+    step = int(max(1, max_bytes // max(trace_bytes, 1)))
+
+    for start in range(0, ntraces, step):
+        stop = min(start + step, ntraces)
+        yield start, stop, read_block(dset, slice(start, stop), channel=channel, window=window)
+
+
+TestInfo = collections.namedtuple('TestInfo', ['segment', 'shape', 'samplerate', 'comment'])
+
+
+class DataSession(object):
+    """Keeps a Sparkle data file open, with an index of the tests it contains
+
+    The index maps each test name to its :class:`TestInfo` (segment, dataset shape,
+    sample rate and segment comment), so looking up a test does not scan the file.
+    Stimulus tables are parsed once per test and kept with the index.
+    It is rebuilt if the file changes on disk.
+
+    :param filename: path of the Sparkle HDF5 file
+    :type filename: str
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.h_file = None
+        self._signature = None
+        self._index = {}
+        self._stim = {}
+        self._open()
+
+    def _open(self):
+        stat = os.stat(self.filename)
+        self.h_file = h5py.File(self.filename, 'r')
+        self._signature = (stat.st_mtime, stat.st_size)
+        self._index = {}
+        self._stim = {}
+        for key in self.h_file.keys():
+            if 'segment' in key:
+                segment = self.h_file[key]
+                samplerate = segment.attrs.get('samplerate_ad')
+                comment = segment.attrs.get('comment', '')
+                for test in segment.keys():
+                    self._index[test] = TestInfo(key, segment[test].shape, samplerate, comment)
+
+    def close(self):
+        """Closes the file"""
+        if self.h_file is not None:
+            self.h_file.close()
+            self.h_file = None
+
+    def refresh(self):
+        """Reopens the file and rebuilds the index if the file changed on disk
+        (by modification time or size) since it was indexed
+
+        :returns: bool -- whether the file had changed
+        """
+        stat = os.stat(self.filename)
+        if (stat.st_mtime, stat.st_size) == self._signature and self.h_file is not None:
+            return False
+        self.close()
+        self._open()
+        return True
+
+    def tests(self):
+        """Names of the tests in the file, in test number order
+
+        :returns: list(str)
+        """
+        return sorted(self._index.keys(), key=lambda test: int(test.replace('test_', '')))
+
+    def info(self, test):
+        """Indexed metadata of a test
+
+        :param test: name of the test, e.g. 'test_1'
+        :type test: str
+        :returns: :class:`TestInfo`
+        """
+        return self._index[test]
+
+    def dataset(self, test):
+        """The (unread) dataset of a test
+
+        :param test: name of the test
+        :type test: str
+        :returns: h5py.Dataset
+        """
+        return self.h_file[self._index[test].segment][test]
+
+    def stim_table(self, test):
+        """Stimulus parameters of every trace of a test, parsed only the first time they are asked for
+
+        :param test: name of the test
+        :type test: str
+        :returns: :class:`StimTable<util.stiminfo.StimTable>`
+        """
+        if test not in self._stim:
+            self._stim[test] = StimTable.from_attr(self.dataset(test).attrs['stim'])
+        return self._stim[test]
@@ -0,0 +1,142 @@
+"""Min/max envelopes of recordings, for drawing long traces at screen resolution
+
+A :class:`MinMaxPyramid` keeps successively decimated minima and maxima of a
+block of reps, so the envelope of any sample range at any zoom is reduced from
+the coarsest level that still resolves a pixel, rather than from raw samples.
+"""
+import numpy as np
+
+# decimation between successive pyramid levels
+PYRAMID_FACTOR = 4
+# levels are added until one is no longer than this
+MIN_LEVEL_SIZE = 256
+
+
+def level_sizes(nsamples, factor=PYRAMID_FACTOR, min_size=MIN_LEVEL_SIZE):
+    """Number of bins in each level of the pyramid of a recording
+
+    :param nsamples: length of the recording
+    :type nsamples: int
+    :returns: list(int) -- bins per level, finest first
+    """
+    sizes = []
+    size = nsamples
+    while size > min_size:
+        size = -(-size // factor)
+        sizes.append(size)
+    return sizes
+
+
+def decimate(block, factor=PYRAMID_FACTOR, min_size=MIN_LEVEL_SIZE):
+    """Computes the pyramid levels of every recording in a block
+
+    :param block: samples, with time along the last axis, e.g. (trace, rep, sample)
+    :type block: numpy array
+    :returns: list((numpy array, numpy array)) -- (minima, maxima) of each level, finest first,
+    shaped as the block with the last axis decimated
+    """
+    block = np.asarray(block)
+    levels = []
+    lo = hi = block
+    while lo.shape[-1] > min_size:
+        offsets = np.arange(0, lo.shape[-1], factor)
+        lo = np.minimum.reduceat(lo, offsets, axis=-1)
+        hi = np.maximum.reduceat(hi, offsets, axis=-1)
+        levels.append((lo, hi))
+    return levels
+
+
+class MinMaxPyramid(object):
+    """Multi-resolution min/max decimation of a block of reps
+
+    Level k holds, for every rep, the minimum and maximum of consecutive runs of
+    factor**(k+1) samples.
+
+    :param data: samples, indexed by (rep, sample); read for full resolution views
+    :type data: numpy array, or an object reading it on demand like :class:`TraceBlock<util.datasource.TraceBlock>`
+    :param levels: (minima, maxima) of each level, finest first, each indexed by (rep, bin)
+    :type levels: list((numpy array, numpy array))
+    :param factor: decimation between levels
+    :type factor: int
+    """
+    def __init__(self, data, levels, factor=PYRAMID_FACTOR):
+        self.data = data
+        self.levels = levels
+        self.factor = factor
+        self.nreps, self.nsamples = data.shape
+
+    @classmethod
+    def from_block(cls, block, factor=PYRAMID_FACTOR, min_size=MIN_LEVEL_SIZE):
+        """Builds the pyramid of a block of reps
+
+        :param block: samples, indexed by (rep, sample)
+        :type block: numpy array
+        :returns: :class:`MinMaxPyramid`
+        """
+        block = np.asarray(block)
+        return cls(block, decimate(block, factor, min_size), factor)
+
+    @property
+    def nbytes(self):
+        """Memory held by the levels, and by the samples if they are in memory"""
+        nbytes = sum(lo.nbytes + hi.nbytes for lo, hi in self.levels)
+        if isinstance(self.data, np.ndarray):
+            nbytes += self.data.nbytes
+        return nbytes
+
+    def extent(self):
+        """Minimum and maximum of each rep, from the coarsest level
+
+        :returns: (numpy array, numpy array) -- (minima, maxima), indexed by rep
+        """
+        if not self.levels:
+            data = np.asarray(self.data[:, :])
+            return data.min(axis=-1), data.max(axis=-1)
+        lo, hi = self.levels[-1]
+        return lo.min(axis=-1), hi.max(axis=-1)
+
+    def envelope(self, start, stop, npixels):
+        """Envelope of the samples in [start, stop), at about npixels columns
+
+        Each column is given as its minimum followed by its maximum, so the
+        envelope can be drawn as a connected line. When the range has no more
+        than two samples per column, the raw samples are returned instead.
+
+        :param start: first sample
+        :type start: int
+        :param stop: sample after the last
+        :type stop: int
+        :param npixels: number of columns to reduce to
+        :type npixels: int
+        :returns: (numpy array, numpy array) -- sample index of each point, and values indexed by (rep, point)
+        """
+        start = max(0, start)
+        stop = min(self.nsamples, stop)
+        if stop <= start:
+            return np.zeros(0, dtype=int), np.zeros((self.nreps, 0))
+
+        per_pixel = (stop - start) / float(max(npixels, 1))
+        if per_pixel <= 2:
+            return np.arange(start, stop), np.asarray(self.data[:, start:stop])
+
+        # coarsest level whose bins are no wider than a column
+        level = 0
+        size = 1
+        while level < len(self.levels) and size * self.factor <= per_pixel:
+            level += 1
+            size *= self.factor
+        first = start // size
+        last = -(-stop // size)
+        if level == 0:
+            lo = hi = np.asarray(self.data[:, first:last])
+        else:
+            lo = self.levels[level - 1][0][:, first:last]
+            hi = self.levels[level - 1][1][:, first:last]
+
+        offsets = np.arange(0, last - first, int(np.ceil(per_pixel / size)))
+        lo = np.minimum.reduceat(lo, offsets, axis=-1)
+        hi = np.maximum.reduceat(hi, offsets, axis=-1)
+        y = np.empty((self.nreps, 2 * len(offsets)), dtype=lo.dtype)
+        y[:, 0::2] = lo
+        y[:, 1::2] = hi
+        return np.repeat((first + offsets) * size, 2), y
@@ -0,0 +1,53 @@
+"""Least recently used cache under a memory budget, shared by the caches of traces and spikes"""
+import collections
+
+
+class LRUCache(object):
+    """Values by key, evicting the least recently used ones to keep their size under a budget
+
+    The most recently added value is always kept, even if it is over the budget on
+    its own. The cache is not locked; callers used from several threads lock around it.
+
+    :param max_bytes: memory budget of the cache
+    :type max_bytes: int
+    :param size: gives the memory held by a value, in bytes
+    :type size: callable
+    """
+    def __init__(self, max_bytes, size):
+        self.max_bytes = max_bytes
+        self.size = size
+        self._values = collections.OrderedDict()
+        self._bytes = 0
+
+    def __len__(self):
+        return len(self._values)
+
+    def __contains__(self, key):
+        return key in self._values
+
+    @property
+    def nbytes(self):
+        """Memory held by the values, by their size function"""
+        return self._bytes
+
+    def get(self, key):
+        """Value kept under key, marked as the most recently used, or None"""
+        value = self._values.pop(key, None)
+        if value is not None:
+            self._values[key] = value
+        return value
+
+    def put(self, key, value):
+        """Keeps a value, evicting the least recently used ones over the budget"""
+        if key in self._values:
+            self._bytes -= self.size(self._values.pop(key))
+        self._values[key] = value
+        self._bytes += self.size(value)
+        while self._bytes > self.max_bytes and len(self._values) > 1:
+            _, evicted = self._values.popitem(last=False)
+            self._bytes -= self.size(evicted)
+
+    def clear(self):
+        """Forgets all values"""
+        self._values.clear()
+        self._bytes = 0
@@ -0,0 +1,233 @@
+"""Threshold-independent index of the peaks of a trace, for fast re-detection at any threshold
+
+At a threshold th, the spikes of a recording are found in the runs of samples
+over th. A local maximum of value v is the maximum of its run exactly when
+th < v and th >= its saddle: the highest level at which it is still joined to a
+higher sample, i.e. the larger of the minima between it and the nearest higher
+sample on either side (-inf on a side with no higher sample). Storing v and the
+saddle of every local maximum, sorted by v, turns finding the runs at a new
+threshold into a binary search and a comparison.
+
+get_spike_times does not always report the maximum of a run: it leaves the last
+sample of a run out of its argmax, and takes the second sample of some two
+sample runs. The index keeps the samples of the trace, so the few runs where
+that matters are looked at again, and the spikes are exactly those detected by
+:func:`batch_spike_samples<util.spikestats.batch_spike_samples>`.
+"""
+import numpy as np
+
+from spikestats import batch_refractory
+
+
+def _nearest_higher(value, valley, strict=False):
+    """For each maximum, the nearest one on its left that is at least as high (higher if strict),
+    and the lowest valley between them
+
+    Found by pointer jumping: each maximum still higher than the one it points
+    to takes over that one's pointer, so the number of rounds grows only with
+    the logarithm of the distance searched.
+
+    :param value: value of each maximum, the first being an +inf sentinel
+    :type value: numpy array
+    :param valley: minimum of the samples between each maximum and the next
+    :type valley: numpy array
+    :returns: (nearest, lowest) -- index of the nearest higher maximum, and the lowest valley in between
+    """
+    nearest = np.arange(len(value)) - 1
+    nearest[0] = 0
+    lowest = np.empty(len(value), dtype=valley.dtype)
+    lowest[0] = np.inf
+    lowest[1:] = valley
+    todo = np.arange(1, len(value))
+    while len(todo) > 0:
+        if strict:
+            todo = todo[~(value[nearest[todo]] > value[todo])]
+        else:
+            todo = todo[value[nearest[todo]] < value[todo]]
+        # sentinels stop the search at the start of each rep
+        todo = todo[value[todo] < np.inf]
+        jump = nearest[todo]
+        lowest[todo] = np.minimum(lowest[todo], lowest[jump])
+        nearest[todo] = nearest[jump]
+    return nearest, lowest
+
+
+def _peaks(signal):
+    """Local maxima of every rep that can be the maximum of a run, with their saddles
+
+    The nearest higher sample of a local maximum lies just after (or before) the
+    nearest higher local maximum, so saddles are found from the sequence of
+    local maxima and the valleys between them, without scanning samples.
+
+    :param signal: samples, indexed by (rep, sample)
+    :type signal: numpy array
+    :returns: (rep, sample, saddle) of each local maximum, ordered by rep then sample
+    """
+    nreps, nsamples = signal.shape
+    # each rep is preceded by an +inf sentinel, and one more ends the last rep
+    width = nsamples + 1
+    flat = np.full(nreps * width + 1, np.inf, dtype=signal.dtype)
+    flat[:-1].reshape(nreps, width)[:, 1:] = signal
+    # the maximum of a run is taken at its first occurrence, so it is above
+    # the sample before it and no lower than the one after it
+    is_max = np.ones((nreps, width), dtype=bool)
+    is_max[:, 2:] &= signal[:, 1:] > signal[:, :-1]
+    is_max[:, 1:-1] &= signal[:, :-1] >= signal[:, 1:]
+    pos = np.append(np.flatnonzero(is_max), len(flat) - 1)
+    value = flat[pos]
+    valley = np.minimum.reduceat(flat, pos)[:-1]
+
+    left, left_low = _nearest_higher(value, valley)
+    # the nearest strictly higher maximum on the right, from the reversed sequence
+    right, right_low = _nearest_higher(value[::-1].copy(), valley[::-1].copy(), strict=True)
+    right = len(pos) - 1 - right[::-1]
+    right_low = right_low[::-1]
+    saddle = np.maximum(np.where(value[left] < np.inf, left_low, -np.inf),
+                        np.where(value[right] < np.inf, right_low, -np.inf))
+
+    real = value < np.inf
+    pos = pos[real]
+    return pos // width, pos % width - 1, saddle[real].astype(signal.dtype)
+
+
+class PeakIndex(object):
+    """Local maxima of every rep of a trace, sorted by amplitude, with the samples they were found in
+
+    :param signal: samples as thresholded (after the absolute value or inversion), indexed by (rep, sample)
+    :type signal: numpy array
+    :param amplitude: value of each maximum, in decreasing order
+    :type amplitude: numpy array
+    :param saddle: saddle of each maximum
+    :type saddle: numpy array
+    :param rep: rep of each maximum
+    :type rep: numpy array
+    :param sample: sample index of each maximum
+    :type sample: numpy array
+    :param fs: sample rate of the recording
+    :type fs: float
+    """
+    def __init__(self, signal, amplitude, saddle, rep, sample, fs):
+        self.signal = signal
+        self.amplitude = amplitude
+        self.saddle = saddle
+        self.rep = rep
+        self.sample = sample
+        self.fs = fs
+        self.nreps, self.nsamples = signal.shape
+
+    def __len__(self):
+        return len(self.amplitude)
+
+    @property
+    def nbytes(self):
+        """Memory held by the index and the samples"""
+        return (self.signal.nbytes + self.amplitude.nbytes + self.saddle.nbytes + self.rep.nbytes
+                + self.sample.nbytes)
+
+    @classmethod
+    def from_block(cls, block, fs, absval=True, polarity=1):
+        """Indexes the local maxima of a block of reps
+
+        :param block: samples, indexed by (rep, sample)
+        :type block: numpy array
+        :param fs: sample rate of the recording
+        :type fs: float
+        :param absval: Whether to index the absolute value of the signal
+        :type absval: bool
+        :param polarity: 1, or -1 to index the inverted signal, without absval
+        :type polarity: int
+        :returns: :class:`PeakIndex`
+        """
+        signal = np.asarray(block)
+        if signal.dtype.kind != 'f':
+            signal = signal.astype(float)
+        if absval:
+            signal = np.abs(signal)
+        elif polarity != 1:
+            signal = signal * polarity
+        rep, sample, saddle = _peaks(signal)
+        amplitude = signal[rep, sample]
+        order = np.argsort(-amplitude, kind='mergesort')
+        return cls(signal, amplitude[order], saddle[order], rep[order].astype(np.int32),
+                   sample[order].astype(np.int32), fs)
+
+    def _over(self, rep, sample, threshold):
+        """Whether each sample is over threshold, False outside the recording"""
+        inside = (sample >= 0) & (sample < self.nsamples)
+        over = np.zeros(len(sample), dtype=bool)
+        over[inside] = self.signal[rep[inside], sample[inside]] > threshold
+        return over
+
+    def _runs(self, threshold):
+        """Rep and sample of the maximum of every run over threshold, ordered by rep then sample"""
+        # number of maxima over threshold, compared as detection compares samples
+        nabove = len(self.amplitude) - np.searchsorted(self.amplitude[::-1], threshold, side='right')
+        while nabove > 0 and not self.amplitude[nabove - 1] > threshold:
+            nabove -= 1
+        while nabove < len(self.amplitude) and self.amplitude[nabove] > threshold:
+            nabove += 1
+        active = np.flatnonzero(~(self.saddle[:nabove] > threshold))
+        keys = np.sort(self.rep[active].astype(np.int64) * self.nsamples + self.sample[active])
+        return keys // self.nsamples, keys % self.nsamples
+
+    def _left_max(self, rep, last, threshold):
+        """First argmax of the samples of each run before its last sample, given the run's rep and last sample"""
+        found = np.empty(len(last), dtype=int)
+        todo = np.arange(len(last))
+        width = 16
+        while len(todo) > 0:
+            first = last[todo] - width
+            cols = first[:, None] + np.arange(width)
+            inside = cols >= 0
+            values = self.signal[rep[todo][:, None], np.maximum(cols, 0)].astype(float)
+            outside = ~(inside & (values > threshold))
+            # the run starts after the last sample of the window that is not over threshold
+            starts = outside.any(axis=1)
+            start = width - np.argmax(outside[:, ::-1], axis=1)
+            values[np.arange(width) < start[:, None]] = -np.inf
+            found[todo[starts]] = first[starts] + np.argmax(values[starts], axis=1)
+            todo = todo[~starts]
+            width *= 4
+        return found
+
+    def spike_samples(self, threshold, refract=0.002):
+        """Spikes of every rep at a threshold, as batch_spike_samples detects them
+
+        :param threshold: Threshold value to determine spikes
+        :type threshold: float
+        :param refract: Refractory period in seconds
+        :type refract: float
+        :returns: (samples, offsets) -- int32 sample index of every spike, ordered by rep,
+        and the start of each rep's spikes in samples, followed by len(samples)
+        """
+        rep, peak = self._runs(threshold)
+        # the extent of each run around its maximum, as far as get_spike_times' peak choice needs it
+        before = self._over(rep, peak - 1, threshold)
+        after = self._over(rep, peak + 1, threshold)
+        single = ~before & ~after
+        two_after = after & ~before & ~self._over(rep, peak + 2, threshold)
+        two_before = before & ~after & ~self._over(rep, peak - 2, threshold)
+        ends_at_max = before & ~after & ~two_before
+
+        # a two sample run gives its first sample, or its second if it is the first run
+        # of its rep, or the second after a single sample first run
+        first_in_rep = np.ones(len(rep), dtype=bool)
+        first_in_rep[1:] = rep[1:] != rep[:-1]
+        second_in_rep = np.zeros(len(rep), dtype=bool)
+        second_in_rep[1:] = first_in_rep[:-1] & ~first_in_rep[1:] & single[:-1]
+        two = two_after | two_before
+        run_start = np.where(two_before, peak - 1, peak)
+        peak = np.where(two, run_start + (first_in_rep | second_in_rep), peak)
+        # a longer run whose maximum is its last sample gives the maximum of the rest
+        peak[ends_at_max] = self._left_max(rep[ends_at_max], peak[ends_at_max], threshold)
+
+        offsets = np.searchsorted(rep, np.arange(self.nreps + 1))
+        samples, offsets = batch_refractory(peak.astype(np.int32), offsets, refract, self.fs)
+        return samples, offsets
+
+    def counts(self, threshold, refract=0.002):
+        """Number of spikes in each rep at a threshold
+
+        :returns: numpy int array, indexed by rep
+        """
+        return np.diff(self.spike_samples(threshold, refract)[1])
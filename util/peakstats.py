@@ -0,0 +1,122 @@
+"""Per-rep peak statistics of whole tests, the basis of automatic thresholds
+
+A single chunked pass over a test gives the statistics of every trace, rep and
+channel, so thresholds for any channel are available without reading the data again.
+"""
+import numpy as np
+
+from datasource import iter_chunks
+from spikestats import QuantileSketch, mad_noise
+
+# fraction of the average peak used by peak thresholds
+THRESH_FRACTION = 0.7
+# multiple of the noise level used by noise thresholds
+NOISE_FACTOR = 4.0
+# quantile of |x| used by percentile thresholds
+PERCENTILE = 0.999
+
+
+class PeakStats(object):
+    """Statistics of every rep of a test
+
+    * peak -- maximum absolute value, indexed by (trace, rep, channel)
+    * sketches -- :class:`QuantileSketch<util.spikestats.QuantileSketch>` of |x| over each whole channel,
+      or None if they were not computed
+    """
+    def __init__(self, peak, sketches=None):
+        self.peak = peak
+        self.sketches = sketches
+
+    @property
+    def nchannels(self):
+        return self.peak.shape[2]
+
+    def peak_threshold(self, channel=None, trace=None, fraction=THRESH_FRACTION):
+        """Threshold from the average peak of the reps of a trace, as auto_threshold computes it
+
+        :param channel: channel, None for single channel tests
+        :type channel: int
+        :param trace: trace to use, or None for all of them
+        :type trace: int
+        :param fraction: fraction of the average peak to return
+        :type fraction: float
+        :returns: float
+        """
+        if trace is None:
+            return fraction * self.peak[:, :, channel or 0].mean()
+        return fraction * self.peak[trace, :, channel or 0].mean()
+
+    def _sketch(self, channel):
+        if self.sketches is None:
+            raise ValueError('Statistics were computed without sketches, see peak_stats')
+        return self.sketches[channel or 0]
+
+    def noise_threshold(self, channel=None, factor=NOISE_FACTOR):
+        """Threshold at a multiple of the noise level median(|x|) / 0.6745 of a whole channel
+
+        :param channel: channel, None for single channel tests
+        :type channel: int
+        :param factor: multiple of the noise level to return
+        :type factor: float
+        :returns: float
+        """
+        return factor * mad_noise(self._sketch(channel))
+
+    def percentile_threshold(self, channel=None, q=PERCENTILE):
+        """Threshold at a quantile of |x| over a whole channel
+
+        :param channel: channel, None for single channel tests
+        :type channel: int
+        :param q: quantile, between 0 and 1
+        :type q: float
+        :returns: float
+        """
+        return self._sketch(channel).quantile(q)
+
+    def threshold(self, method='peak', channel=None, **kwargs):
+        """Threshold by one of the methods:
+
+        * 'peak' -- fraction of the average peak of a trace, or of all traces
+        * 'mad' -- multiple of the noise level median(|x|) / 0.6745 of the whole channel
+        * 'percentile' -- quantile of |x| over the whole channel
+
+        :param method: 'peak', 'mad' or 'percentile'
+        :type method: str
+        :param channel: channel, None for single channel tests
+        :type channel: int
+        :param kwargs: passed on to peak_threshold, noise_threshold or percentile_threshold
+        :returns: float
+        """
+        if method == 'peak':
+            return self.peak_threshold(channel, **kwargs)
+        if method == 'mad':
+            return self.noise_threshold(channel, **kwargs)
+        if method == 'percentile':
+            return self.percentile_threshold(channel, **kwargs)
+        raise ValueError('Unknown threshold method: ' + str(method))
+
+
+def peak_stats(dset, progress=None, sketches=False):
+    """Computes the :class:`PeakStats` of every trace, rep and channel of a test, a block of traces at a time
+
+    :param dset: test dataset
+    :type dset: h5py.Dataset
+    :param progress: called with (traces done, total traces) after each block
+    :type progress: callable
+    :param sketches: whether to also sketch |x| of each channel, which the 'mad' and 'percentile'
+    thresholds need. It takes much longer than finding the peaks.
+    :type sketches: bool
+    :returns: :class:`PeakStats`
+    """
+    shape = dset.shape[:2] + ((dset.shape[2],) if len(dset.shape) == 4 else (1,))
+    peak = np.empty(shape)
+    channel_sketches = [QuantileSketch() for _ in range(shape[2])] if sketches else None
+    for start, stop, block in iter_chunks(dset):
+        block = np.abs(block).reshape((stop - start,) + shape[1:] + (dset.shape[-1],))
+        peak[start:stop] = block.max(axis=-1)
+        if sketches:
+            for channel, sketch in enumerate(channel_sketches):
+                sketch.update(block[:, :, channel])
+        if progress is not None:
+            progress(stop, dset.shape[0])
+    return PeakStats(peak, channel_sketches)
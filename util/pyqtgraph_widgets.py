@@ -6,10 +6,15 @@ from QtWrapper import QtCore, QtGui
 
 import spikestats
 from QtWrapper import QtCore
+from envelope import MinMaxPyramid
 from raster_bounds_dlg import RasterBoundsDialog
 from viewbox import SpikeyViewBox
 
 STIM_HEIGHT = 0.05
+# envelope width used before the view has been laid out
+DEFAULT_ENVELOPE_WIDTH = 1000
+# initial number of points the raster buffer holds
+RASTER_CAPACITY = 1024
 
 # Switch to using white background and black foreground
 pg.setConfigOption('background', 'w')
@@ -95,6 +100,8 @@ class TraceWidget(BasePlot):
     _polarity = 1
     _ampScalar = None
     _abs = True
+    # (x, pyramid, polarity, items) of the traces drawn by addTraces
+    _envelope = None
 
     def __init__(self, parent=None):
         super(TraceWidget, self).__init__(parent)
@@ -106,6 +113,7 @@ class TraceWidget(BasePlot):
         self.tracePlot.curve.setToolTip("Spike Trace")
 
         self.sigRangeChanged.connect(self.rangeChange)
+        self.getPlotItem().vb.sigResized.connect(lambda vb: self.updateEnvelope())
 
         self.disableAutoRange()
 
@@ -131,6 +139,13 @@ class TraceWidget(BasePlot):
         self.updateRasterBounds()
         self.trace_stash = []
         self.legend_names = []
+        # curve items of traces, reused across calls to addTraces
+        self._curvePool = []
+        # raster points, in buffers of which the first _rasterCount entries are used
+        self._rasterX = np.empty(0)
+        self._rasterY = np.empty(0)
+        self._rasterCount = 0
+        self._rasterPending = False
 
     def updateData(self, axeskey, x, y):
         """Replaces the currently displayed data
@@ -158,54 +173,95 @@ class TraceWidget(BasePlot):
             self.tracePlot.setData(x, y * self._polarity)
 
     def addTraces(self, x, ys):
+        """Plots the reps of a trace, each as its min/max envelope at the resolution of the view
+
+        The envelopes are recomputed from a min/max pyramid whenever the visible range changes,
+        so zooming in down to a single spike shows the full resolution samples.
+
+        :param x: time of each sample, evenly spaced
+        :type x: numpy.ndarray
+        :param ys: samples, indexed by (rep, sample), or their pyramid
+        :type ys: numpy.ndarray or :class:`MinMaxPyramid<util.envelope.MinMaxPyramid>`
+        """
         self.clearTraces()
-        nreps = ys.shape[0]
+        if not isinstance(ys, MinMaxPyramid):
+            ys = MinMaxPyramid.from_block(ys)
+        nreps = ys.nreps
+        items = []
         for irep in range(nreps):
-            self.trace_stash.append(self.plot(x, ys[irep, :] * self._polarity, pen=(irep, nreps)))
+            items.append(self._takeCurve((irep, nreps)))
+        self._envelope = (x, ys, self._polarity, items)
+        self.updateEnvelope()
+
+    def updateEnvelope(self):
+        """Redraws the traces added by addTraces for the current x range and view width"""
+        if self._envelope is None:
+            return
+        x, pyramid, polarity, items = self._envelope
+        if len(x) > 1:
+            dx = (x[-1] - x[0]) / float(len(x) - 1)
+            xmin, xmax = self.viewRange()[0]
+            start = int(np.floor((xmin - x[0]) / dx))
+            stop = int(np.ceil((xmax - x[0]) / dx)) + 1
+        else:
+            start, stop = 0, len(x)
+        width = int(self.getPlotItem().vb.width()) or DEFAULT_ENVELOPE_WIDTH
+        index, y = pyramid.envelope(start, stop, width)
+        for irep, item in enumerate(items):
+            item.setData(x[index], y[irep] * polarity)
 
     def addTracesABR(self, x, ys, intensity, trace_num):
         self.clearTraces()
         nreps = ys.shape[0]
         for irep in reversed(range(nreps)):
-            self.trace_stash.append(self.plot(x, ys[irep, :], pen=(irep, nreps)))
-            line = self.plot(pen=pg.intColor(irep, hues=nreps))
-            self.legend.addItem(line, 'trace_' + str(trace_num[irep]) + ': ' + str(intensity[irep]) + ' dB')
+            curve = self._takeCurve((irep, nreps))
+            curve.setData(x, ys[irep, :])
+            self.legend.addItem(curve, 'trace_' + str(trace_num[irep]) + ': ' + str(intensity[irep]) + ' dB')
             self.legend_names.append('trace_' + str(trace_num[irep]) + ': ' + str(intensity[irep]) + ' dB')
 
     def addTraceAverage(self, x, ys, label):
         nreps = ys.shape[0]
         for irep in reversed(range(nreps)):
-            self.trace_stash.append(self.plot(x, ys[irep, :], pen=(irep, nreps)))
-            line = self.plot(pen=pg.intColor(irep, hues=nreps))
-            self.legend.addItem(line, label)
+            curve = self._takeCurve((irep, nreps))
+            curve.setData(x, ys[irep, :])
+            self.legend.addItem(curve, label)
             self.legend_names.append(label)
         self.resetPen()
 
     def resetPen(self):
-        temp = []
-        temp2 = self.legend
-        temp3 = []
-
-        for name in self.legend_names:
-            temp2.removeItem(name)
+        """Recolors the shown traces evenly across the hue range, keeping their data"""
+        nreps = len(self.trace_stash)
+        for irep, curve in enumerate(self.trace_stash):
+            curve.setPen((irep, nreps))
+        if self.legend_names:
+            # the legend samples are drawn from the curves themselves
+            self.legend.update()
 
-        self.clearTraces()
+    def _takeCurve(self, pen):
+        """Shows the next unused curve item of the pool, creating it only if the pool is exhausted
 
-        nreps = len(self.trace_stash)
-        for irep in range(nreps):
-            temp.append(self.plot(self.trace_stash[irep].getData()[0], self.trace_stash[irep].getData()[1], pen=(irep, nreps)))
-            line = self.plot(pen=pg.intColor(irep, hues=nreps))
-            temp2.addItem(line, self.legend_names[irep])
-            temp3.append(self.legend_names[irep])
-        self.trace_stash = temp
-        self.legend = temp2
-        self.legend_names = temp3
+        :param pen: pen for the curve, as accepted by pyqtgraph.mkPen
+        :returns: pyqtgraph.PlotDataItem
+        """
+        n = len(self.trace_stash)
+        if n == len(self._curvePool):
+            self._curvePool.append(self.plot())
+        curve = self._curvePool[n]
+        curve.setPen(pen)
+        curve.show()
+        self.trace_stash.append(curve)
+        return curve
 
     def clearTraces(self):
+        """Hides the shown traces, keeping their items for reuse"""
+        self._envelope = None
         for trace in self.trace_stash:
-            self.removeItem(trace)
+            trace.clear()
+            trace.hide()
         for name in self.legend_names:
             self.legend.removeItem(name)
+        self.trace_stash = []
+        self.legend_names = []
 
     def removeLegend(self):
         self.legend.scene().removeItem(self.legend)
@@ -221,17 +277,31 @@ class TraceWidget(BasePlot):
         :type ypoints: numpy.ndarray
         """
         if axeskey == 'raster' and len(bins) > 0:
-            x, y = self.rasterPlot.getData()
             # don't plot overlapping points
             bins = np.unique(bins)
+            count = self._rasterCount + len(bins)
+            if count > len(self._rasterX):
+                # grow by doubling, so appending is linear in the total number of points
+                capacity = max(count, 2 * len(self._rasterX), RASTER_CAPACITY)
+                self._rasterX = np.concatenate([self._rasterX[:self._rasterCount], np.empty(capacity - self._rasterCount)])
+                self._rasterY = np.concatenate([self._rasterY[:self._rasterCount], np.empty(capacity - self._rasterCount)])
+            self._rasterX[self._rasterCount:count] = bins
             # adjust repetition number to response scale
-            ypoints = np.ones_like(bins)*self.rasterYslots[ypoints[0]]
-            x = np.append(x, bins)
-            y = np.append(y, ypoints)
-            self.rasterPlot.setData(x, y)
+            self._rasterY[self._rasterCount:count] = self.rasterYslots[ypoints[0]]
+            self._rasterCount = count
+            # points appended before control returns to the event loop are plotted together
+            if not self._rasterPending:
+                self._rasterPending = True
+                QtCore.QTimer.singleShot(0, self.refreshRaster)
+
+    def refreshRaster(self):
+        """Plots the raster points appended so far"""
+        self._rasterPending = False
+        self.rasterPlot.setData(self._rasterX[:self._rasterCount], self._rasterY[:self._rasterCount])
 
     def clearData(self, axeskey):
         """Clears the raster plot"""
+        self._rasterCount = 0
         self.rasterPlot.clear()
 
     def getThreshold(self):
@@ -336,6 +406,7 @@ class TraceWidget(BasePlot):
             # rmax = self.rasterTop * yrange_size + ranges[1][0]
             # rmin = self.rasterBottom * yrange_size + ranges[1][0]
             self.updateRasterBounds()
+            self.updateEnvelope()
 
     def update_thresh(self):
         """Emits a Qt signal thresholdUpdated with the current threshold value"""
@@ -426,12 +497,9 @@ class PSTHWidget(BasePlot):
         fs = 1./(times[1] - times[0])
 
         # process response; calculate spike times
-        spike_times = spikestats.spike_times(response, self._threshold, fs)
+        spike_times = spikestats.spike_times(response, self._threshold, fs, as_train=True)
         self.spike_counts.append(len(spike_times))
-        if len(spike_times) > 0:
-            self.spike_latencies.append(spike_times[0])
-        else:
-            self.spike_latencies.append(np.nan)
+        self.spike_latencies.append(spike_times.latency())
         self.spike_rates.append(spikestats.firing_rate(spike_times, times))
 
         binsz = self._bins[1] - self._bins[0]
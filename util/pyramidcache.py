@@ -0,0 +1,157 @@
+"""Sidecar files caching the min/max pyramids of the traces of a data file
+
+The pyramids of data.hdf5 are stored next to it in data.pyramid.h5, with one
+group per test and channel holding a (trace, rep, bin) dataset of minima and
+of maxima for each level. The sidecar records the size and modification time
+of the data file, and is rebuilt from scratch when they no longer match.
+"""
+import os
+
+import h5py
+
+from datasource import TraceBlock, iter_chunks, num_channels, read_block
+from envelope import MIN_LEVEL_SIZE, PYRAMID_FACTOR, MinMaxPyramid, decimate, level_sizes
+
+SUFFIX = '.pyramid.h5'
+
+
+def sidecar_path(filename):
+    """Path of the pyramid sidecar of a data file"""
+    return os.path.splitext(filename)[0] + SUFFIX
+
+
+class PyramidCache(object):
+    """Min/max pyramids of the traces of a data file, built as they are first asked for
+    and kept in a sidecar file
+
+    If the sidecar is turned off or cannot be written (e.g. a read-only directory),
+    pyramids are still returned, but computed from the samples every time. A
+    sidecar that can be written but not opened (e.g. truncated) is made again.
+
+    :param filename: path of the Sparkle HDF5 file
+    :type filename: str
+    :param sidecar: whether to keep the pyramids in the sidecar file
+    :type sidecar: bool
+    """
+    def __init__(self, filename, factor=PYRAMID_FACTOR, min_size=MIN_LEVEL_SIZE, sidecar=True):
+        self.filename = filename
+        self.path = sidecar_path(filename)
+        self.factor = factor
+        self.min_size = min_size
+        stat = os.stat(filename)
+        self.signature = (stat.st_mtime, stat.st_size)
+        self.h_file = None
+        if sidecar:
+            self._open()
+
+    def _writable(self):
+        """Whether the sidecar could be written, by its permissions and those of its directory"""
+        if not os.access(os.path.dirname(os.path.abspath(self.path)), os.W_OK):
+            return False
+        return not os.path.exists(self.path) or os.access(self.path, os.W_OK)
+
+    def _open(self):
+        try:
+            self.h_file = h5py.File(self.path, 'a')
+        except (IOError, OSError):
+            self.h_file = None
+            if not os.path.exists(self.path) or not self._writable():
+                return
+            # the sidecar is damaged, e.g. truncated, so it is started again
+            try:
+                os.remove(self.path)
+                self.h_file = h5py.File(self.path, 'w')
+            except (IOError, OSError):
+                self.h_file = None
+                return
+        attrs = self.h_file.attrs
+        if (attrs.get('source_mtime') != self.signature[0] or attrs.get('source_size') != self.signature[1]
+                or attrs.get('factor') != self.factor or attrs.get('min_size') != self.min_size):
+            self.h_file.close()
+            self.h_file = h5py.File(self.path, 'w')
+            self.h_file.attrs['source_mtime'] = self.signature[0]
+            self.h_file.attrs['source_size'] = self.signature[1]
+            self.h_file.attrs['factor'] = self.factor
+            self.h_file.attrs['min_size'] = self.min_size
+
+    def close(self):
+        """Closes the sidecar file"""
+        if self.h_file is not None:
+            self.h_file.close()
+            self.h_file = None
+
+    def _group(self, dset, test, channel):
+        """Group of a test channel's pyramids, created on first use"""
+        name = test + '/channel_' + str(channel or 0)
+        if name in self.h_file:
+            return self.h_file[name]
+        group = self.h_file.create_group(name)
+        ntraces, nreps, nsamples = dset.shape[0], dset.shape[1], dset.shape[-1]
+        group.create_dataset('built', shape=(ntraces,), dtype=bool)
+        for k, size in enumerate(level_sizes(nsamples, self.factor, self.min_size)):
+            for kind in ('min', 'max'):
+                group.create_dataset('%s_%d' % (kind, k), shape=(ntraces, nreps, size), dtype=dset.dtype,
+                                     chunks=(1, nreps, size))
+        return group
+
+    def _write(self, group, traces, levels):
+        for k, (lo, hi) in enumerate(levels):
+            group['min_%d' % k][traces] = lo
+            group['max_%d' % k][traces] = hi
+        group['built'][traces] = True
+
+    def pyramid(self, dset, test, trace, channel=None):
+        """Pyramid of a trace, read from the sidecar or computed (and stored) if it is not there yet
+
+        The pyramid's samples are read from dset only when needed; if the pyramid
+        had to be computed, they are kept in memory.
+
+        :param dset: test dataset
+        :type dset: h5py.Dataset
+        :param test: name of the test
+        :type test: str
+        :param trace: trace index
+        :type trace: int
+        :param channel: channel, for multi-channel tests
+        :type channel: int
+        :returns: :class:`MinMaxPyramid<util.envelope.MinMaxPyramid>`
+        """
+        if len(dset.shape) == 3:
+            channel = None
+        if self.h_file is not None:
+            group = self._group(dset, test, channel)
+            if group['built'][trace]:
+                levels = []
+                for k in range(len(level_sizes(dset.shape[-1], self.factor, self.min_size))):
+                    levels.append((group['min_%d' % k][trace], group['max_%d' % k][trace]))
+                return MinMaxPyramid(TraceBlock(dset, trace, channel), levels, self.factor)
+
+        pyramid = MinMaxPyramid.from_block(read_block(dset, trace, channel=channel), self.factor, self.min_size)
+        if self.h_file is not None:
+            self._write(group, trace, pyramid.levels)
+            self.h_file.flush()
+        return pyramid
+
+    def build(self, session, tests=None):
+        """Computes and stores the pyramids of every trace and channel of tests, a block of traces at a time
+
+        :param session: open data file
+        :type session: :class:`DataSession<util.datasource.DataSession>`
+        :param tests: names of the tests, or None for all of them
+        :type tests: list(str)
+        """
+        if self.h_file is None:
+            raise IOError('Cannot write ' + self.path)
+        if tests is None:
+            tests = session.tests()
+        for test in tests:
+            dset = session.dataset(test)
+            for channel in range(num_channels(dset)):
+                group = self._group(dset, test, channel)
+                built = group['built'][:]
+                if built.all():
+                    continue
+                for start, stop, block in iter_chunks(dset, channel if len(dset.shape) == 4 else None):
+                    if not built[start:stop].all():
+                        self._write(group, slice(start, stop), decimate(block, self.factor, self.min_size))
+        self.h_file.flush()
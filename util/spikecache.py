@@ -0,0 +1,131 @@
+"""Spike times of single traces, found at any threshold from an index of their peaks
+
+The viewer shows the spikes of the selected trace as a raster and PSTH. Each
+trace is indexed once per absolute value and polarity setting, with its
+samples, so moving the threshold neither reads the trace again nor scans its
+samples. Spikes are those detected for tuning curves, so the raster agrees
+with the curve at the same threshold.
+"""
+import numpy as np
+
+from lrucache import LRUCache
+from peakindex import PeakIndex
+from spikestats import SpikeTrain, window_samples
+
+
+class TraceSpikes(object):
+    """Spikes detected in every rep of one trace
+
+    * samples -- int32 sample index of every spike in the recording, ordered by rep
+    * offsets -- start of each rep's spikes in samples, followed by len(samples)
+    * fs -- sample rate of the recording
+    """
+    def __init__(self, samples, offsets, fs):
+        self.samples = samples
+        self.offsets = offsets
+        self.fs = fs
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def nbytes(self):
+        return self.samples.nbytes + self.offsets.nbytes
+
+    def counts(self):
+        """Number of spikes in each rep
+
+        :returns: numpy int array, indexed by rep
+        """
+        return np.diff(self.offsets)
+
+    def train(self, rep):
+        """Spikes of one rep
+
+        :param rep: rep index
+        :type rep: int
+        :returns: :class:`SpikeTrain<util.spikestats.SpikeTrain>`
+        """
+        return SpikeTrain(self.samples[self.offsets[rep]:self.offsets[rep + 1]], self.fs)
+
+    def within(self, window):
+        """Spikes that peak within a window
+
+        :param window: (start, stop) times in seconds, or None for all spikes
+        :type window: (float, float)
+        :returns: :class:`TraceSpikes`
+        """
+        if window is None:
+            return self
+        samples, offsets = window_samples(self.samples, self.offsets, int(np.floor(window[0] * self.fs)),
+                                          int(np.floor(window[1] * self.fs)))
+        return TraceSpikes(samples, offsets, self.fs)
+
+
+def index_trace(data, fs, absval=True, polarity=1):
+    """Indexes the peaks of every rep of a whole trace
+
+    :param data: samples, indexed by (rep, sample)
+    :type data: numpy array or :class:`TraceBlock<util.datasource.TraceBlock>`
+    :param fs: sample rate of the recording
+    :type fs: float
+    :param absval: Whether to apply absolute value to signal before thresholding
+    :type absval: bool
+    :param polarity: 1, or -1 to invert the signal before thresholding
+    :type polarity: int
+    :returns: :class:`PeakIndex<util.peakindex.PeakIndex>`
+    """
+    return PeakIndex.from_block(np.asarray(data[:, :]), fs, absval, polarity)
+
+
+class SpikeCache(object):
+    """Peak indexes of whole traces, kept by (test, trace, channel, absval, polarity)
+
+    The spikes of a trace at any threshold are found from its index, and a new
+    window is applied to them with :meth:`TraceSpikes.within`, without detecting
+    again. The least recently used indexes are evicted to keep the cache under a
+    memory budget. The cache is for a single data file; clear it when the file changes.
+
+    :param max_bytes: memory budget of the cache
+    :type max_bytes: int
+    """
+    def __init__(self, max_bytes=64 * 2 ** 20):
+        self._indexes = LRUCache(max_bytes, lambda index: index.nbytes)
+
+    def __len__(self):
+        return len(self._indexes)
+
+    @staticmethod
+    def key(test, trace, channel, threshold, absval=True, polarity=1):
+        """Key of the spikes of a trace, detected with these parameters"""
+        return test, trace, channel, threshold, absval, polarity
+
+    @staticmethod
+    def _index_key(key):
+        test, trace, channel, _, absval, polarity = key
+        return test, trace, channel, absval, polarity
+
+    def clear(self):
+        """Forgets all indexes"""
+        self._indexes.clear()
+
+    def put(self, key, index):
+        """Keeps the index of a trace, evicting the least recently used ones over the budget
+
+        :param key: key of spikes of the trace, at any threshold
+        :type key: tuple
+        :param index: index of the whole trace, as returned by :func:`index_trace`
+        :type index: :class:`PeakIndex<util.peakindex.PeakIndex>`
+        """
+        self._indexes.put(self._index_key(key), index)
+
+    def get(self, key):
+        """Spikes of a trace, from its index, or None if the trace is not indexed
+
+        :returns: :class:`TraceSpikes`
+        """
+        index = self._indexes.get(self._index_key(key))
+        if index is None:
+            return None
+        samples, offsets = index.spike_samples(key[3])
+        return TraceSpikes(samples, offsets, index.fs)
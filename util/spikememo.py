@@ -0,0 +1,78 @@
+"""Spikes of whole tests detected during a GUI session, kept in memory
+
+Going back to a test, channel and threshold already analyzed gives its tuning
+curve without detecting spikes or reading the spike store again. The least
+recently used results are evicted to keep the memo under a memory budget.
+"""
+import threading
+
+from lrucache import LRUCache
+
+
+class SpikeMemo(object):
+    """Results of :func:`detect_spikes<util.tuning.detect_spikes>`, by data file, test and detection parameters
+
+    Workers use the memo from their own threads, so it is locked. hits and
+    misses count the lookups that found a result and those that did not.
+
+    :param max_bytes: memory budget of the memo
+    :type max_bytes: int
+    """
+    def __init__(self, max_bytes=64 * 2 ** 20):
+        self.hits = 0
+        self.misses = 0
+        self._memo = LRUCache(max_bytes, self._size)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._memo)
+
+    @property
+    def max_bytes(self):
+        return self._memo.max_bytes
+
+    @property
+    def nbytes(self):
+        return self._memo.nbytes
+
+    @staticmethod
+    def key(filename, test, channel, threshold, absval=True, polarity=1):
+        """Key of the spikes of a test, detected with these parameters"""
+        # polarity makes no difference to the absolute value
+        return filename, test, channel, threshold, absval, 1 if absval else polarity
+
+    def get(self, key):
+        """Spikes kept under key, or None, counting a hit or a miss
+
+        :returns: (samples, offsets, shape) or None
+        """
+        with self._lock:
+            spikes = self._memo.get(key)
+            if spikes is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return spikes
+
+    def put(self, key, spikes):
+        """Keeps the spikes of a test, evicting the least recently used ones over the budget
+
+        :param spikes: (samples, offsets, shape), as returned by detect_spikes
+        :type spikes: tuple
+        """
+        with self._lock:
+            self._memo.put(key, spikes)
+
+    @staticmethod
+    def _size(spikes):
+        return spikes[0].nbytes + spikes[1].nbytes
+
+    def clear(self):
+        """Forgets all spikes; the hit and miss counts are kept"""
+        with self._lock:
+            self._memo.clear()
+
+    def summary(self):
+        """Hits, misses and memory use, for the message log"""
+        return 'Spike memo: %d hits, %d misses, %d tests in %.1f MB' % (self.hits, self.misses, len(self._memo),
+                                                                        self._memo.nbytes / 2.0 ** 20)
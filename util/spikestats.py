@@ -2,26 +2,153 @@
 import numpy as np
 
 
-def refractory(times, refract=0.002):
+class SpikeTrain(object):
+    """Spike times of one recording, stored as sample indices
+
+    :param samples: sample index of each spike
+    :type samples: numpy array
+    :param fs: Sample rate of the recording
+    :type fs: float
+    """
+    __slots__ = ('samples', 'fs')
+
+    def __init__(self, samples, fs):
+        self.samples = np.asarray(samples, dtype=np.int32)
+        self.fs = fs
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __repr__(self):
+        return 'SpikeTrain(%d spikes, fs=%s)' % (len(self.samples), self.fs)
+
+    @property
+    def seconds(self):
+        """numpy array of spike times in seconds"""
+        return self.samples / float(self.fs)
+
+    @property
+    def ms(self):
+        """numpy array of spike times in milliseconds"""
+        return 1000 * self.seconds
+
+    def latency(self):
+        """Time of the first spike in seconds, or nan if there are no spikes"""
+        if len(self.samples) == 0:
+            return np.nan
+        return self.samples[0] / float(self.fs)
+
+
+def _as_seconds(spike_times):
+    """Spike times in seconds, from a SpikeTrain or a sequence of times"""
+    if isinstance(spike_times, SpikeTrain):
+        return spike_times.seconds
+    return np.asarray(spike_times, dtype=float)
+
+
+def refractory(times, refract=0.002, fs=None):
     """Removes spikes in times list that do not satisfy refractor period
 
-    :param times: list(float) of spike times in seconds
-    :type times: list(float)
+    :param times: sorted spike times in seconds, or sample indices if fs is given
+    :type times: numpy array
     :param refract: Refractory period in seconds
     :type refract: float
-    :returns: list(float) of spike times in seconds
+    :param fs: Sample rate, if times are sample indices
+    :type fs: float
+    :returns: numpy array of the spike times (or sample indices) that are kept
 
     For every interspike interval < refract,
     removes the second spike time in list and returns the result"""
-    times_refract = []
-    times_refract.append(times[0])
-    for i in range(1, len(times)):
-        if times_refract[-1] + refract <= times[i]:
-            times_refract.append(times[i])
-    return times_refract
+    times = np.asarray(times)
+    kept, _ = batch_refractory(times, [0, len(times)], refract, fs)
+    return kept
+
 
+def batch_refractory(times, offsets, refract=0.002, fs=None):
+    """Applies the refractory period to many spike trains at once
 
-def get_spike_times(signal, threshold, fs, absval=True):
+    :param times: spike times in seconds (or sample indices if fs is given) of all trains, concatenated, each train sorted
+    :type times: numpy array
+    :param offsets: start of each train in times, followed by len(times)
+    :type offsets: numpy array
+    :param refract: Refractory period in seconds
+    :type refract: float
+    :param fs: Sample rate, if times are sample indices
+    :type fs: float
+    :returns: (times, offsets) -- the kept spike times, and the start of each train in them
+
+    Keeps the first spike of each train, then every spike at least refract
+    after the last spike kept, the same as calling refractory on each train"""
+    times = np.asarray(times)
+    offsets = np.asarray(offsets)
+    keep = _refractory_mask(times, offsets, refract, fs)
+    kept_before = np.concatenate(([0], np.cumsum(keep)))
+    return times[keep], kept_before[offsets]
+
+
+def window_samples(samples, offsets, start, stop):
+    """Keeps the spikes of many spike trains that are within a window
+
+    :param samples: sample indices of the spikes of all trains, concatenated
+    :type samples: numpy array
+    :param offsets: start of each train in samples, followed by len(samples)
+    :type offsets: numpy array
+    :param start: first sample of the window
+    :type start: int
+    :param stop: sample after the window
+    :type stop: int
+    :returns: (samples, offsets) -- the kept spikes, and the start of each train in them
+    """
+    samples = np.asarray(samples)
+    offsets = np.asarray(offsets)
+    keep = (samples >= start) & (samples < stop)
+    kept_before = np.concatenate(([0], np.cumsum(keep)))
+    return samples[keep], kept_before[offsets]
+
+
+def _refractory_mask(times, offsets, refract, fs):
+    """Boolean mask of the spikes in times that survive the refractory period"""
+    if fs is not None:
+        seconds = times / float(fs)
+    else:
+        seconds = times.astype(float)
+    nspikes = len(seconds)
+    if nspikes == 0:
+        return np.zeros(0, dtype=bool)
+
+    # a spike far enough after its predecessor is always kept, since the last
+    # kept spike can be no later than that predecessor
+    head = np.ones(nspikes, dtype=bool)
+    head[1:] = seconds[:-1] + refract <= seconds[1:]
+    train_starts = offsets[:-1][np.diff(offsets) > 0]
+    head[train_starts] = True
+    if head.all():
+        return head
+
+    # every other spike belongs to a cluster of closely spaced spikes started
+    # by a head. Find, for each spike, the next one that is far enough after it
+    # within its cluster, by searching on (cluster, time) keys (complex numbers
+    # sort lexicographically on real then imaginary part)
+    cluster = np.cumsum(head) - 1
+    keys = cluster + 1j * seconds
+    following = np.searchsorted(keys, cluster + 1j * (seconds + refract))
+
+    # the kept spikes of a cluster are the chain head, following[head],
+    # following[following[head]], ... Mark every chain at once by pointer
+    # doubling: jumps[k] skips 2**k links, and nspikes is the end of a chain
+    step = np.append(following, nspikes)
+    step[np.append(head, True)[step]] = nspikes
+    jumps = [step]
+    while (jumps[-1][:-1] < nspikes).any():
+        jumps.append(jumps[-1][jumps[-1]])
+
+    keep = np.append(head, False)
+    for jump in reversed(jumps):
+        keep[jump[keep]] = True
+    return keep[:-1]
+
+
+def get_spike_times(signal, threshold, fs, absval=True, as_train=False):
     """Detect spikes from a given signal
 
     :param signal: Spike trace recording (vector)
@@ -30,11 +157,13 @@ def get_spike_times(signal, threshold, fs, absval=True):
     :type threshold: float
     :param absval: Whether to apply absolute value to signal before thresholding
     :type absval: bool
-    :returns: list(float) of spike times in seconds
+    :param as_train: Whether to return a SpikeTrain instead of times in seconds
+    :type as_train: bool
+    :returns: numpy array of spike times in seconds, or :class:`SpikeTrain`
 
     For every continuous set of points over given threshold,
     returns the time of the maximum"""
-    times = []
+    peaks = []
     if absval:
         signal = np.abs(signal)
     over, = np.where(signal > threshold)
@@ -49,14 +178,14 @@ def get_spike_times(signal, threshold, fs, absval=True):
                 segments = np.insert(segments, [0], [0])
             else:
                 # first point in singleton
-                times.append(float(over[0]) / fs)
+                peaks.append(over[0])
                 if 1 not in segments:
                     # make sure that first point is in there
                     segments[0] = 1
             if segments[-1] != len(over) - 1:
                 segments = np.insert(segments, [len(segments)], [len(over) - 1])
             else:
-                times.append(float(over[-1]) / fs)
+                peaks.append(over[-1])
 
         for iseg in range(1, len(segments)):
             if segments[iseg] - segments[iseg - 1] == 1:
@@ -67,17 +196,17 @@ def get_spike_times(signal, threshold, fs, absval=True):
                 # find maximum of continuous set over max
                 idx = over[segments[iseg - 1] + 1] + np.argmax(
                     signal[over[segments[iseg - 1] + 1]:over[segments[iseg]]])
-            times.append(float(idx) / fs)
+            peaks.append(idx)
     elif len(over) == 1:
-        times.append(float(over[0]) / fs)
+        peaks.append(over[0])
 
-    if len(times) > 0:
-        return refractory(times)
-    else:
-        return times
+    train = SpikeTrain(refractory(np.array(peaks, dtype=int), fs=fs), fs)
+    if as_train:
+        return train
+    return train.seconds
 
 
-def spike_times(signal, threshold, fs, absval=True):
+def spike_times(signal, threshold, fs, absval=True, as_train=False):
     """Detect spikes from a given signal
 
     :param signal: Spike trace recording (vector)
@@ -86,11 +215,13 @@ def spike_times(signal, threshold, fs, absval=True):
     :type threshold: float
     :param absval: Whether to apply absolute value to signal before thresholding
     :type absval: bool
-    :returns: list(float) of spike times in seconds
+    :param as_train: Whether to return a SpikeTrain instead of times in seconds
+    :type as_train: bool
+    :returns: numpy array of spike times in seconds, or :class:`SpikeTrain`
 
     For every continuous set of points over given threshold, 
     returns the time of the maximum"""
-    times = []
+    peaks = []
     if absval:
         signal = np.abs(signal)
     over, = np.where(signal > threshold)
@@ -105,14 +236,14 @@ def spike_times(signal, threshold, fs, absval=True):
                 segments = np.insert(segments, [0], [0])
             else:
                 # first point in singleton
-                times.append(float(over[0]) / fs)
+                peaks.append(over[0])
                 if 1 not in segments:
                     # make sure that first point is in there
                     segments[0] = 1
             if segments[-1] != len(over) - 1:
                 segments = np.insert(segments, [len(segments)], [len(over) - 1])
             else:
-                times.append(float(over[-1]) / fs)
+                peaks.append(over[-1])
 
         for iseg in range(1, len(segments)):
             if segments[iseg] - segments[iseg - 1] == 1:
@@ -123,43 +254,151 @@ def spike_times(signal, threshold, fs, absval=True):
                 # find maximum of continuous set over max
                 idx = over[segments[iseg - 1] + 1] + np.argmax(
                     signal[over[segments[iseg - 1] + 1]:over[segments[iseg]]])
-            times.append(float(idx) / fs)
+            peaks.append(idx)
     elif len(over) == 1:
-        times.append(float(over[0]) / fs)
+        peaks.append(over[0])
+
+    train = SpikeTrain(refractory(np.array(peaks, dtype=int), fs=fs), fs)
+    if as_train:
+        return train
+    return train.seconds
 
-    if len(times) > 0:
-        return refractory(times)
+
+# upper bound on the number of samples thresholded at once by batch_spike_times
+BATCH_SAMPLES = 2 ** 24
+
+
+def batch_spike_times(dset, threshold, fs, absval=True, channel=None):
+    """Detect spikes for every recording in a dataset in one vectorized pass
+
+    :param dset: Recordings with samples along the last axis, e.g. (trace, rep, samples) or (trace, rep, channel, samples)
+    :type dset: numpy array
+    :param threshold: Threshold value to determine spikes
+    :type threshold: float
+    :param fs: Sample rate of the recordings
+    :type fs: float
+    :param absval: Whether to apply absolute value to signal before thresholding
+    :type absval: bool
+    :param channel: Index of the channel to use, if dset has a channel axis (4 dimensions). If None, all channels are kept.
+    :type channel: int
+    :returns: (counts, trains) -- int array of spike counts with the shape of dset minus the sample axis,
+    and an object array of the same shape holding the :class:`SpikeTrain` of each recording
+
+    Gives the same spike times as calling get_spike_times on each recording"""
+    samples, offsets, lead_shape = batch_spike_samples(dset, threshold, fs, absval, channel)
+    trains = np.empty(len(offsets) - 1, dtype=object)
+    for irow in range(len(trains)):
+        trains[irow] = SpikeTrain(samples[offsets[irow]:offsets[irow + 1]], fs)
+    return np.diff(offsets).reshape(lead_shape), trains.reshape(lead_shape)
+
+
+def batch_spike_samples(dset, threshold, fs, absval=True, channel=None):
+    """Detect spikes for every recording in a dataset, as one flat array of sample indices
+
+    Takes the same parameters as batch_spike_times.
+
+    :returns: (samples, offsets, shape) -- int32 sample index of every spike, ordered by recording;
+    the start of each recording's spikes in samples, followed by len(samples);
+    and the shape of dset minus the sample axis, in which recordings are ordered
+    """
+    if channel is not None and len(dset.shape) == 4:
+        dset = dset[:, :, channel, :]
+    dset = np.asarray(dset)
+    lead_shape = dset.shape[:-1]
+    nsamples = dset.shape[-1]
+    rows = dset.reshape(-1, nsamples)
+
+    samples = []
+    counts = []
+    block = max(1, BATCH_SAMPLES // max(nsamples, 1))
+    for start in range(0, rows.shape[0], block):
+        nrows = min(block, rows.shape[0] - start)
+        peaks, row_of_peak = _batch_peaks(rows[start:start + nrows], threshold, absval)
+        offsets = np.searchsorted(row_of_peak, np.arange(nrows + 1))
+        peaks, offsets = batch_refractory(peaks, offsets, fs=fs)
+        samples.append(peaks.astype(np.int32))
+        counts.append(np.diff(offsets))
+
+    offsets = np.zeros(rows.shape[0] + 1, dtype=int)
+    if len(counts) > 0:
+        np.cumsum(np.concatenate(counts), out=offsets[1:])
+        samples = np.concatenate(samples)
     else:
-        return times
+        samples = np.zeros(0, dtype=np.int32)
+    return samples, offsets, lead_shape
+
+
+def _batch_peaks(rows, threshold, absval):
+    """Finds the peak sample of every continuous set of points over threshold,
+    for each row of a 2D array, using the same peak choice as get_spike_times
+
+    :returns: (peaks, row_of_peak) -- sample index of each peak and the row it belongs to, ordered by row then sample
+    """
+    nsamples = rows.shape[1]
+    signal = rows.ravel()
+    if absval:
+        signal = np.abs(signal)
+    over = np.flatnonzero(signal > threshold)
+    if len(over) == 0:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+
+    row_of_over = over // nsamples
+    # a new segment starts wherever samples are not adjacent, or a new row starts
+    new_seg = np.ones(len(over), dtype=bool)
+    new_seg[1:] = (np.diff(over) != 1) | (np.diff(row_of_over) != 0)
+    seg_start = np.flatnonzero(new_seg)
+    seg_len = np.diff(np.append(seg_start, len(over)))
+    seg_row = row_of_over[seg_start]
+    seg_id = np.cumsum(new_seg) - 1
+
+    # get_spike_times takes the maximum of all but the last point of a segment
+    pos_in_seg = np.arange(len(over)) - seg_start[seg_id]
+    searched = pos_in_seg < np.maximum(seg_len - 1, 1)[seg_id]
+    values = np.where(searched, signal[over], -np.inf)
+    seg_max = np.maximum.reduceat(values, seg_start)
+    # first occurrence of the maximum, like np.argmax
+    at_max = np.where(searched & (values == seg_max[seg_id]), over, len(signal))
+    peaks = np.minimum.reduceat(at_max, seg_start)
+
+    # ... except for a two point segment that is first in its row (or second,
+    # after a single point first segment), where it takes the second point
+    first_in_row = np.ones(len(seg_start), dtype=bool)
+    first_in_row[1:] = np.diff(seg_row) != 0
+    second_in_row = np.zeros(len(seg_start), dtype=bool)
+    second_in_row[1:] = first_in_row[:-1] & ~first_in_row[1:] & (seg_len[:-1] == 1)
+    takes_second = (seg_len == 2) & (first_in_row | second_in_row)
+    peaks[takes_second] = over[seg_start[takes_second] + 1]
+
+    return peaks - seg_row * nsamples, seg_row
 
 
 def bin_spikes(spike_times, binsz):
     """Sort spike times into bins
 
     :param spike_times: times of spike instances
-    :type spike_times: list
+    :type spike_times: list or :class:`SpikeTrain`
     :param binsz: length of time bin to use
     :type binsz: float
     :returns: list of bin indicies, one for each element in spike_times
     """
-    bins = np.empty((len(spike_times),), dtype=int)
-    for i, stime in enumerate(spike_times):
-        # around to fix rounding errors
-        bins[i] = np.floor(np.around(stime / binsz, 5))
-    return bins
+    # around to fix rounding errors
+    return np.floor(np.around(_as_seconds(spike_times) / binsz, 5)).astype(int)
 
 
-def spike_latency(signal, threshold, fs):
+def spike_latency(signal, threshold=None, fs=None):
     """Find the latency of the first spike over threshold
 
-    :param signal: Spike trace recording (vector)
-    :type signal: numpy array
-    :param threshold: Threshold value to determine spikes
+    :param signal: Spike trace recording (vector), or already detected spikes
+    :type signal: numpy array or :class:`SpikeTrain`
+    :param threshold: Threshold value to determine spikes, not needed for a SpikeTrain
     :type threshold: float
     :returns: float -- Time of peak of first spike, or None if no values over threshold
 
     This is the same as the first value returned from calc_spike_times
     """
+    if isinstance(signal, SpikeTrain):
+        return signal.latency()
+
     over, = np.where(signal > threshold)
     segments, = np.where(np.diff(over) > 1)
 
@@ -186,13 +425,14 @@ def firing_rate(spike_times, window_size=None):
     """Calculate the firing rate of spikes
 
     :param spike_times: times of spike instances
-    :type spike_times: list
+    :type spike_times: list or :class:`SpikeTrain`
     :param window_size: length of time to use to determine rate.
     If none, uses time from first to last spike in spike_times
     :type window_size: float
     """
     if len(spike_times) == 0:
         return 0
+    spike_times = _as_seconds(spike_times)
 
     if window_size is None:
         if len(spike_times) > 1:
@@ -210,18 +450,104 @@ def firing_rate(spike_times, window_size=None):
 def dataset_spike_counts(dset, threshold, fs):
     """Dataset should be of dimensions (trace, rep, samples)"""
     if len(dset.shape) == 3:
-        results = np.zeros(dset.shape[0])
-        for itrace in range(dset.shape[0]):
-            results[itrace] = count_spikes(dset[itrace], threshold, fs)
-        return results
-    elif len(dset.shape == 2):
+        counts, _ = batch_spike_times(dset, threshold, fs)
+        return counts.sum(axis=1).astype(float)
+    elif len(dset.shape) == 2:
         return count_spikes(dset, threshold, fs)
     else:
         raise Exception("Improper data dimensions")
 
 
 def count_spikes(dset, threshold, fs):
-    trace_count = 0
-    for irep in range(dset.shape[0]):
-        trace_count += len(spike_times(dset[irep, :], threshold, fs))
-    return trace_count
+    counts, _ = batch_spike_times(dset, threshold, fs)
+    return int(counts.sum())
+
+
+# median(|x|) / NOISE_SCALE estimates the standard deviation of gaussian noise
+NOISE_SCALE = 0.6745
+
+
+class QuantileSketch(object):
+    """Summary of the distribution of |x|, for quantiles of data too large to hold in memory
+
+    Values are counted in logarithmic buckets, bucket i holding values in
+    (gamma**(i-1), gamma**i] with gamma = (1 + accuracy) / (1 - accuracy), so a
+    quantile is estimated within a relative error of accuracy, however far
+    artifacts stretch the range. Values up to min_value are counted as zero.
+    The buckets kept grow to cover the values seen.
+
+    :param accuracy: relative accuracy of quantile estimates
+    :type accuracy: float
+    :param min_value: values with a magnitude up to this count as zero
+    :type min_value: float
+    """
+    def __init__(self, accuracy=0.005, min_value=1e-12):
+        self.accuracy = accuracy
+        self.min_value = min_value
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self.zeros = 0
+        self.offset = 0
+        self.counts = np.zeros(0, dtype=np.int64)
+
+    @property
+    def count(self):
+        """Number of values summarized"""
+        return self.zeros + int(self.counts.sum())
+
+    def _cover(self, first, last):
+        """Extends the buckets to cover bucket indices first to last"""
+        if len(self.counts) == 0:
+            self.offset = first
+            self.counts = np.zeros(last - first + 1, dtype=np.int64)
+            return
+        first = min(first, self.offset)
+        last = max(last, self.offset + len(self.counts) - 1)
+        if first < self.offset or last >= self.offset + len(self.counts):
+            counts = np.zeros(last - first + 1, dtype=np.int64)
+            counts[self.offset - first:self.offset - first + len(self.counts)] = self.counts
+            self.offset = first
+            self.counts = counts
+
+    def update(self, values):
+        """Adds the absolute values of an array to the summary
+
+        :param values: signal samples, of any shape
+        :type values: numpy array
+        """
+        values = np.abs(np.asarray(values, dtype=float)).ravel()
+        nonzero = values > self.min_value
+        self.zeros += len(values) - int(nonzero.sum())
+        values = values[nonzero]
+        if len(values) == 0:
+            return
+        buckets = np.ceil(np.log(values) / np.log(self.gamma)).astype(np.int64)
+        self._cover(buckets.min(), buckets.max())
+        self.counts += np.bincount(buckets - self.offset, minlength=len(self.counts))
+
+    def quantile(self, q):
+        """Estimates a quantile of the absolute values summarized
+
+        :param q: quantile, between 0 and 1
+        :type q: float
+        :returns: float -- the estimate, or nan if no values were added
+        """
+        if self.count == 0:
+            return np.nan
+        rank = q * (self.count - 1)
+        if rank < self.zeros:
+            return 0.0
+        cumulative = np.cumsum(self.counts)
+        bucket = self.offset + np.searchsorted(cumulative, rank - self.zeros, side='right')
+        bucket = min(bucket, self.offset + len(self.counts) - 1)
+        return 2 * self.gamma ** bucket / (self.gamma + 1)
+
+
+def mad_noise(sketch):
+    """Noise level median(|x|) / 0.6745 from a sketch of a zero-centered signal,
+    the standard deviation for gaussian noise, insensitive to spikes and artifacts
+
+    :param sketch: summary of the signal
+    :type sketch: :class:`QuantileSketch`
+    :returns: float
+    """
+    return sketch.quantile(0.5) / NOISE_SCALE
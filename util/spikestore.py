@@ -0,0 +1,161 @@
+"""Spike detection results of whole tests, kept on disk across sessions
+
+Results are stored in an SQLite database, keyed by the data file (path, size
+and modification time) and every detection parameter (test, channel, threshold,
+absolute value and polarity), so generating a tuning curve again, e.g. with
+other contour levels or the next day, does not detect spikes again. Results
+of a data file that has changed since are dropped. The least recently used
+results are evicted to keep the store under a size budget.
+"""
+import os
+import sqlite3
+import time
+
+import numpy as np
+
+from tuning import detect_spikes
+
+# default size budget of the stored spikes, in bytes
+MAX_BYTES = 256 * 2 ** 20
+
+
+def default_path():
+    """Path of the store shared by the GUI sessions of a user"""
+    return os.path.join(os.path.expanduser('~'), '.tuning_curves', 'spikes.sqlite')
+
+
+class SpikeStore(object):
+    """Spike sample indices of every (trace, rep) of tests, by data file and detection parameters
+
+    An SQLite connection can only be used by the thread that opened it, so open
+    the store on the thread that detects spikes.
+
+    :param path: path of the database file, created if it does not exist
+    :type path: str
+    :param max_bytes: size budget of the stored spikes
+    :type max_bytes: int
+    """
+    def __init__(self, path=None, max_bytes=MAX_BYTES):
+        if path is None:
+            path = default_path()
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.db = sqlite3.connect(path, timeout=30)
+        self.db.execute('CREATE TABLE IF NOT EXISTS spikes ('
+                        'key TEXT PRIMARY KEY, source TEXT, signature TEXT, ntraces INTEGER, nreps INTEGER, '
+                        'samples BLOB, offsets BLOB, nbytes INTEGER, last_used REAL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS spikes_last_used ON spikes (last_used)')
+        self.db.commit()
+
+    def close(self):
+        """Closes the database"""
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    @staticmethod
+    def _key(filename, test, channel, threshold, absval, polarity):
+        """Source path, signature of its contents and key of a result"""
+        source = os.path.abspath(filename)
+        stat = os.stat(source)
+        signature = repr((stat.st_mtime, stat.st_size))
+        # polarity makes no difference to the absolute value
+        params = (test, channel, float(threshold), bool(absval), 1 if absval else int(polarity))
+        return source, signature, repr((source, signature) + params)
+
+    def get(self, filename, test, channel, threshold, absval=True, polarity=1):
+        """Stored spikes of a test, or None if they were not stored with these parameters
+
+        :param filename: path of the Sparkle HDF5 file
+        :type filename: str
+        :param test: name of the test
+        :type test: str
+        :param channel: channel, None for single channel tests
+        :type channel: int
+        :param threshold: Threshold value the spikes were detected at
+        :type threshold: float
+        :param absval: Whether the absolute value of the signal was thresholded
+        :type absval: bool
+        :param polarity: 1, or -1 if the signal was inverted
+        :type polarity: int
+        :returns: (samples, offsets, shape) as returned by :func:`detect_spikes<util.tuning.detect_spikes>`, or None
+        """
+        _, _, key = self._key(filename, test, channel, threshold, absval, polarity)
+        row = self.db.execute('SELECT ntraces, nreps, samples, offsets FROM spikes WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        self.db.execute('UPDATE spikes SET last_used = ? WHERE key = ?', (time.time(), key))
+        self.db.commit()
+        ntraces, nreps, samples, offsets = row
+        return (np.frombuffer(samples, dtype='<i4').astype(np.int32),
+                np.frombuffer(offsets, dtype='<i8').astype(int), (ntraces, nreps))
+
+    def put(self, filename, test, channel, threshold, absval, polarity, samples, offsets, shape):
+        """Stores the spikes of a test, then evicts the least recently used results over the size budget
+
+        Takes the parameters of :meth:`get`, plus the (samples, offsets, shape) to store.
+        Results of older versions of the data file are dropped.
+        """
+        source, signature, key = self._key(filename, test, channel, threshold, absval, polarity)
+        samples = np.asarray(samples, dtype='<i4').tobytes()
+        offsets = np.asarray(offsets, dtype='<i8').tobytes()
+        self.db.execute('DELETE FROM spikes WHERE source = ? AND signature != ?', (source, signature))
+        self.db.execute('INSERT OR REPLACE INTO spikes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                        (key, source, signature, shape[0], shape[1], sqlite3.Binary(samples),
+                         sqlite3.Binary(offsets), len(samples) + len(offsets), time.time()))
+        self._evict()
+        self.db.commit()
+
+    def _evict(self):
+        total = 0
+        stale = []
+        for key, nbytes in self.db.execute('SELECT key, nbytes FROM spikes ORDER BY last_used DESC'):
+            total += nbytes
+            if total > self.max_bytes:
+                stale.append((key,))
+        self.db.executemany('DELETE FROM spikes WHERE key = ?', stale)
+
+    def nbytes(self):
+        """Size of the stored spikes, in bytes"""
+        return self.db.execute('SELECT COALESCE(SUM(nbytes), 0) FROM spikes').fetchone()[0]
+
+    def clear(self):
+        """Removes all stored spikes"""
+        self.db.execute('DELETE FROM spikes')
+        self.db.commit()
+        self.db.execute('VACUUM')
+
+
+def stored_spikes(path, filename, dset, fs, test, threshold, channel=None, absval=True, progress=None, polarity=1):
+    """Spikes of a test from the store at path, detecting and storing them if they are not there yet
+
+    The store is only a shortcut: if it cannot be opened, spikes are detected without it.
+    Takes the parameters of :func:`detect_spikes<util.tuning.detect_spikes>`, plus:
+
+    :param path: path of the store, or None for the default one
+    :type path: str
+    :param filename: path of the Sparkle HDF5 file dset is in
+    :type filename: str
+    :param test: name of the test
+    :type test: str
+    :returns: ((samples, offsets, shape), bool) -- the result of detect_spikes, and whether it came from the store
+    """
+    if len(dset.shape) == 3:
+        channel = None
+    params = (filename, test, channel, threshold, absval, polarity)
+    try:
+        store = SpikeStore(path)
+    except (sqlite3.Error, OSError):
+        return detect_spikes(dset, fs, threshold, channel, absval, progress, polarity), False
+    try:
+        spikes = store.get(*params)
+        if spikes is not None:
+            return spikes, True
+        spikes = detect_spikes(dset, fs, threshold, channel, absval, progress, polarity)
+        store.put(*(params + spikes))
+        return spikes, False
+    finally:
+        store.close()
@@ -0,0 +1,73 @@
+"""Parsing of the stimulus metadata Sparkle stores in the stim attribute of a test"""
+import ast
+import json
+
+import numpy as np
+
+
+def parse_stim(text):
+    """Parses a stim attribute without evaluating it as code
+
+    :param text: value of a test's stim attribute, JSON or a python literal
+    :type text: str
+    :returns: list(dict) -- stimulus description of each trace
+    """
+    try:
+        return json.loads(text)
+    except ValueError:
+        return ast.literal_eval(text)
+
+
+class StimTable(object):
+    """Stimulus parameters of every trace of a test, as columns
+
+    Each attribute is a numpy array indexed by trace, taken from the first
+    component of the trace's stimulus:
+
+    * stim_type -- stimulus type name, e.g. 'Pure Tone' or 'silence'
+    * frequency -- frequency in Hz, nan for stimuli without one
+    * intensity -- intensity in dB
+    * ncomponents -- number of components in the stimulus
+    """
+    def __init__(self, stim_type, frequency, intensity, ncomponents):
+        self.stim_type = stim_type
+        self.frequency = frequency
+        self.intensity = intensity
+        self.ncomponents = ncomponents
+
+    def __len__(self):
+        return len(self.stim_type)
+
+    @classmethod
+    def from_stim(cls, stim_info):
+        """Builds a table from parsed stim metadata
+
+        :param stim_info: stimulus description of each trace, as returned by parse_stim
+        :type stim_info: list(dict)
+        :returns: :class:`StimTable`
+        """
+        ntraces = len(stim_info)
+        stim_type = np.empty(ntraces, dtype=object)
+        frequency = np.full(ntraces, np.nan)
+        intensity = np.full(ntraces, np.nan)
+        ncomponents = np.zeros(ntraces, dtype=int)
+        for itrace, trace_stim in enumerate(stim_info):
+            components = trace_stim['components']
+            ncomponents[itrace] = len(components)
+            if len(components) == 0:
+                stim_type[itrace] = ''
+                continue
+            stim_type[itrace] = components[0]['stim_type']
+            frequency[itrace] = components[0].get('frequency', np.nan)
+            intensity[itrace] = components[0].get('intensity', np.nan)
+        return cls(stim_type, frequency, intensity, ncomponents)
+
+    @classmethod
+    def from_attr(cls, text):
+        """Builds a table from the raw stim attribute of a test
+
+        :param text: value of a test's stim attribute
+        :type text: str
+        :returns: :class:`StimTable`
+        """
+        return cls.from_stim(parse_stim(text))
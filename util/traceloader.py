@@ -0,0 +1,208 @@
+"""Background loading of the traces shown in the trace view"""
+import threading
+
+from QtWrapper import QtCore
+
+from datasource import DataSession, TraceBlock
+from lrucache import LRUCache
+from pyramidcache import PyramidCache
+from spikecache import SpikeCache, index_trace
+from tracestats import RepStats
+
+
+class TraceLoader(QtCore.QThread):
+    """Loads the min/max pyramids of traces (all reps of one trace of one channel) on a background thread
+
+    Pyramids come from the data file's :class:`PyramidCache<util.pyramidcache.PyramidCache>`
+    sidecar, so a trace that was viewed before, or prepared with ``batch.py --pyramids``,
+    is shown without reading its samples.
+
+    Each :meth:`request` replaces any requests still waiting, so when the user scrolls
+    quickly through traces only the latest one is read. After the requested trace, the
+    neighbouring traces are prefetched into a small LRU cache, so stepping through
+    traces is served from memory. The per-rep :class:`RepStats<util.tracestats.RepStats>`
+    of each trace are computed on the loading thread and cached with it.
+
+    The peaks of the shown trace are indexed on the loading thread too, when its
+    spikes are asked for with :meth:`requestSpikes`, and the index is kept in a
+    :class:`SpikeCache<util.spikecache.SpikeCache>`, so the spikes at a new
+    threshold are found straight away.
+
+    :param prefetch: number of traces on either side of a request to prefetch
+    :type prefetch: int
+    :param max_bytes: memory budget of the cache
+    :type max_bytes: int
+    :param spike_bytes: memory budget of the peak indexes
+    :type spike_bytes: int
+    :param sidecar: whether to keep the pyramids in the sidecar file of the data file
+    :type sidecar: bool
+    """
+    traceLoaded = QtCore.Signal(object, object, object)
+    loadFailed = QtCore.Signal(object, str)
+    spikesDetected = QtCore.Signal(object, object)
+
+    def __init__(self, prefetch=2, max_bytes=128 * 2 ** 20, spike_bytes=64 * 2 ** 20, sidecar=True, parent=None):
+        super(TraceLoader, self).__init__(parent)
+        self.prefetch = prefetch
+        self.sidecar = sidecar
+        self._filename = None
+        self._session = None
+        self._pyramids = None
+        # (pyramid, stats) of each trace, by (test, trace, channel)
+        self._cache = LRUCache(max_bytes, lambda entry: entry[0].nbytes)
+        self._pending = []
+        self._current = None
+        self._spikes = SpikeCache(spike_bytes)
+        self._spike_request = None
+        self._stopping = False
+        self._lock = threading.Lock()
+        self._wake = threading.Condition(self._lock)
+
+    def setFile(self, filename):
+        """Switches to a new data file (or the same file after it changed), emptying the cache"""
+        with self._lock:
+            self._filename = filename
+            self._cache.clear()
+            self._pending = []
+            self._current = None
+            self._spikes.clear()
+            self._spike_request = None
+
+    def request(self, test, trace, channel, ntraces):
+        """Asks for a trace. traceLoaded is emitted with ((test, trace, channel), pyramid, stats)
+        once it is read, straight away if it is cached.
+
+        :param test: name of the test
+        :type test: str
+        :param trace: trace index
+        :type trace: int
+        :param channel: channel index, None for single channel tests
+        :type channel: int
+        :param ntraces: number of traces in the test, to limit prefetching
+        :type ntraces: int
+        """
+        key = (test, trace, channel)
+        neighbours = []
+        for offset in range(1, self.prefetch + 1):
+            for neighbour in (trace + offset, trace - offset):
+                if 0 <= neighbour < ntraces:
+                    neighbours.append((test, neighbour, channel))
+
+        with self._lock:
+            self._current = key
+            entry = self._cache.get(key)
+            if entry is not None:
+                self._pending = []
+            else:
+                self._pending = [key]
+            self._pending.extend(k for k in neighbours if k not in self._cache)
+            self._wake.notify()
+
+        if entry is not None:
+            self.traceLoaded.emit(key, *entry)
+
+    def requestSpikes(self, test, trace, channel, threshold, absval=True, polarity=1):
+        """Asks for the spikes of a trace. spikesDetected is emitted with
+        ((test, trace, channel, threshold, absval, polarity), :class:`TraceSpikes<util.spikecache.TraceSpikes>`)
+        once the trace is indexed, straight away if it already is.
+
+        Takes the parameters of :meth:`request` (except ntraces), plus the threshold and
+        those of :func:`index_trace<util.spikecache.index_trace>`: spikes of whole traces are returned.
+        """
+        key = SpikeCache.key(test, trace, channel, threshold, absval, polarity)
+        with self._lock:
+            spikes = self._spikes.get(key)
+            self._spike_request = None if spikes is not None else key
+            self._wake.notify()
+        if spikes is not None:
+            self.spikesDetected.emit(key, spikes)
+
+    def stop(self):
+        """Stops the loading thread"""
+        with self._lock:
+            self._stopping = True
+            self._wake.notify()
+        self.wait()
+
+    def run(self):
+        while True:
+            with self._lock:
+                while not self._pending and self._spike_request is None and not self._stopping:
+                    self._wake.wait()
+                if self._stopping:
+                    break
+                filename = self._filename
+                # the shown trace's spikes come before prefetching
+                spike_key = self._spike_request
+                self._spike_request = None
+                if spike_key is None:
+                    key = self._pending.pop(0)
+
+            if spike_key is not None:
+                self._detect(filename, spike_key)
+                continue
+
+            try:
+                entry = self._read(filename, key)
+            except Exception as e:
+                with self._lock:
+                    current = key == self._current
+                if current:
+                    self.loadFailed.emit(key, str(e))
+                continue
+
+            with self._lock:
+                # drop results for a file that was switched away from meanwhile
+                if filename != self._filename:
+                    continue
+                self._cache.put(key, entry)
+                current = key == self._current
+            if current:
+                self.traceLoaded.emit(key, *entry)
+
+        self._close()
+
+    def _detect(self, filename, key):
+        test, trace, channel, threshold, absval, polarity = key
+        try:
+            self._open(filename)
+            with self._lock:
+                entry = self._cache.get((test, trace, channel))
+            # samples kept in memory with a computed pyramid are not read again,
+            # and the index keeps them for later thresholds
+            data = entry[0].data if entry is not None else TraceBlock(self._session.dataset(test), trace, channel)
+            index = index_trace(data, self._session.info(test).samplerate, absval, polarity)
+        except Exception as e:
+            self.loadFailed.emit((test, trace, channel), str(e))
+            return
+        with self._lock:
+            if filename != self._filename:
+                return
+            self._spikes.put(key, index)
+            spikes = self._spikes.get(key)
+        self.spikesDetected.emit(key, spikes)
+
+    def _close(self):
+        if self._pyramids is not None:
+            self._pyramids.close()
+            self._pyramids = None
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+
+    def _open(self, filename):
+        if self._session is not None and self._session.filename != filename:
+            self._close()
+        if self._session is None:
+            self._session = DataSession(filename)
+        elif self._session.refresh() and self._pyramids is not None:
+            self._pyramids.close()
+            self._pyramids = None
+        if self._pyramids is None:
+            self._pyramids = PyramidCache(filename, sidecar=self.sidecar)
+
+    def _read(self, filename, key):
+        self._open(filename)
+        test, trace, channel = key
+        pyramid = self._pyramids.pyramid(self._session.dataset(test), test, trace, channel)
+        return pyramid, RepStats.from_pyramid(pyramid)
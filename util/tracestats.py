@@ -0,0 +1,55 @@
+"""Summary statistics of trace blocks, used to scale the trace view without rescanning samples"""
+import numpy as np
+
+
+class RepStats(object):
+    """Minimum and maximum of every rep of a trace block
+
+    * min -- numpy array of the minimum of each rep
+    * max -- numpy array of the maximum of each rep
+    """
+    __slots__ = ('min', 'max')
+
+    def __init__(self, min, max):
+        self.min = np.asarray(min)
+        self.max = np.asarray(max)
+
+    def __len__(self):
+        return len(self.min)
+
+    @classmethod
+    def from_pyramid(cls, pyramid):
+        """Takes the statistics from the coarsest level of a min/max pyramid, without reading samples
+
+        :param pyramid: pyramid of the trace
+        :type pyramid: :class:`MinMaxPyramid<util.envelope.MinMaxPyramid>`
+        :returns: :class:`RepStats`
+        """
+        return cls(*pyramid.extent())
+
+    def nonzero(self):
+        """Whether each rep has any nonzero sample
+
+        :returns: numpy bool array, indexed by rep
+        """
+        return (self.min != 0) | (self.max != 0)
+
+
+def view_range(stats, rep=None):
+    """Y range to show a trace with
+
+    For a single rep, the range is that rep's extent. For all reps, it is the
+    extent of all of them, including 0; if any rep is entirely zero (not
+    recorded), None is returned.
+
+    :param stats: statistics of the trace's reps
+    :type stats: :class:`RepStats`
+    :param rep: rep to show, or None for all of them
+    :type rep: int
+    :returns: (float, float) -- (ymin, ymax), or None
+    """
+    if rep is not None:
+        return stats.min[rep], stats.max[rep]
+    if not stats.nonzero().all():
+        return None
+    return min(0, stats.min.min()), max(0, stats.max.max())
@@ -0,0 +1,420 @@
+"""Tuning curve computation, independent of the GUI
+
+The functions here take a test dataset (an h5py dataset or numpy array, of
+dimensions (trace, rep, samples) or (trace, rep, channel, samples)) and its
+stimulus table, and return plain numpy results, so they can be profiled,
+parallelized and reused outside of Qt.
+"""
+import numpy as np
+
+from datasource import iter_chunks, read_block
+from peakindex import PeakIndex
+from peakstats import THRESH_FRACTION
+from spikestats import batch_spike_samples, window_samples
+
+
+class Cancelled(Exception):
+    """Raised by a progress callback to stop a computation"""
+
+
+class TuningCurve(object):
+    """Result of :func:`tuning_curve`
+
+    * frequency -- sorted unique stimulus frequencies (kHz)
+    * intensity -- sorted unique stimulus intensities (dB)
+    * Z -- mean spikes per presentation, indexed by (intensity, frequency), nan for cells with no presentations
+    * spikes -- total spike count of each cell, indexed by (intensity, frequency)
+    * presentations -- number of presentations (reps) counted in each cell
+    * trace_counts -- spike count of every (trace, rep)
+    * cells -- statistics of each cell, indexed by (intensity, frequency), see :func:`cell_stats`
+    * latency -- first spike latency in seconds of every (trace, rep), nan for reps without spikes
+    """
+    def __init__(self, frequency, intensity, Z, spikes, presentations, trace_counts, cells=None, latency=None):
+        self.frequency = frequency
+        self.intensity = intensity
+        self.Z = Z
+        self.spikes = spikes
+        self.presentations = presentations
+        self.trace_counts = trace_counts
+        self.cells = cells
+        self.latency = latency
+
+
+def spike_counts(dset, fs, threshold, channel=None, window=None, absval=True, progress=None, polarity=1):
+    """Counts the spikes of every (trace, rep) of a test, reading it a block of traces at a time
+
+    :param dset: test dataset
+    :type dset: h5py.Dataset
+    :param fs: sample rate of the recording
+    :type fs: float
+    :param threshold: Threshold value to determine spikes
+    :type threshold: float
+    :param channel: channel to use, for multi-channel tests
+    :type channel: int
+    :param window: (start, stop) times in seconds to count spikes between. If None, the whole recording is used.
+    Spikes are detected on the whole recording, then those that peak within the window are counted.
+    :type window: (float, float)
+    :param absval: Whether to apply absolute value to signal before thresholding
+    :type absval: bool
+    :param progress: called with (traces done, total traces) after each trace.
+    It may raise :class:`Cancelled` to stop the computation.
+    :type progress: callable
+    :param polarity: 1, or -1 to invert the signal before thresholding, which only matters without absval
+    :type polarity: int
+    :returns: numpy array of spike counts, indexed by (trace, rep)
+    """
+    return spike_counts_latency(dset, fs, threshold, channel, window, absval, progress, polarity)[0]
+
+
+def spike_counts_latency(dset, fs, threshold, channel=None, window=None, absval=True, progress=None, polarity=1):
+    """Counts the spikes of every (trace, rep) of a test and finds the first one, in the same pass
+
+    Takes the same parameters as :func:`spike_counts`.
+
+    :returns: (counts, latency) -- numpy arrays indexed by (trace, rep) of spike counts, and of
+    the time in seconds from the start of the recording to the first spike, as
+    :func:`spike_latency<util.spikestats.spike_latency>` gives it (nan for reps without spikes)
+    """
+    spikes = window_spikes(detect_spikes(dset, fs, threshold, channel, absval, progress, polarity), window, fs)
+    return counts_latency(*(spikes + (fs,)))
+
+
+def detect_spikes(dset, fs, threshold, channel=None, absval=True, progress=None, polarity=1):
+    """Detects the spikes of every (trace, rep) of a test, reading it a block of traces at a time
+
+    Spikes are detected on whole recordings, so the result can be kept and
+    restricted to any window afterwards with :func:`window_spikes`. Takes the
+    same parameters as :func:`spike_counts`, except the window.
+
+    :returns: (samples, offsets, shape) -- int32 sample index of every spike, ordered by (trace, rep);
+    the start of each (trace, rep)'s spikes in samples, followed by len(samples);
+    and the (trace, rep) shape of the test
+    """
+    if len(dset.shape) == 3:
+        channel = None
+
+    samples = []
+    counts = np.zeros(dset.shape[:2], dtype=int)
+
+    def detect(rows, out):
+        if polarity != 1 and not absval:
+            rows = rows * polarity
+        found, offsets, shape = batch_spike_samples(rows, threshold, fs, absval)
+        samples.append(found)
+        counts[out] = np.diff(offsets).reshape(shape)
+
+    for start, stop, block in iter_chunks(dset, channel):
+        if progress is None:
+            detect(block, slice(start, stop))
+        else:
+            # detect a trace at a time, to report on each
+            for itrace in range(stop - start):
+                detect(block[itrace], start + itrace)
+                progress(start + itrace + 1, dset.shape[0])
+
+    offsets = np.zeros(counts.size + 1, dtype=int)
+    np.cumsum(counts.ravel(), out=offsets[1:])
+    samples = np.concatenate(samples) if samples else np.zeros(0, dtype=np.int32)
+    return samples, offsets, counts.shape
+
+
+def window_spikes(spikes, window, fs):
+    """Keeps the spikes that peak within a window, from the result of :func:`detect_spikes`
+
+    :param spikes: (samples, offsets, shape), as returned by detect_spikes
+    :type spikes: tuple
+    :param window: (start, stop) times in seconds, or None to keep every spike
+    :type window: (float, float)
+    :param fs: sample rate of the recording
+    :type fs: float
+    :returns: (samples, offsets, shape) of the spikes within the window
+    """
+    if window is None:
+        return spikes
+    samples, offsets, shape = spikes
+    samples, offsets = window_samples(samples, offsets, int(np.floor(window[0] * fs)), int(np.floor(window[1] * fs)))
+    return samples, offsets, shape
+
+
+def counts_latency(samples, offsets, shape, fs):
+    """Spike counts and first spike latencies of every (trace, rep), from the result of :func:`detect_spikes`
+
+    :returns: (counts, latency), as returned by :func:`spike_counts_latency`
+    """
+    counts = np.diff(offsets)
+    latency = np.full(len(counts), np.nan)
+    latency[counts > 0] = samples[offsets[:-1][counts > 0]] / float(fs)
+    return counts.reshape(shape), latency.reshape(shape)
+
+
+def tuning_curve(dset, fs, stim, threshold, channel=None, window=None, absval=True, progress=None, polarity=1):
+    """Computes the mean spikes per presentation on a frequency x intensity grid
+
+    Silence traces are left out of the grid. Takes the same parameters as
+    :func:`spike_counts`, plus:
+
+    :param stim: stimulus parameters of the test
+    :type stim: :class:`StimTable<util.stiminfo.StimTable>`
+    :returns: :class:`TuningCurve`
+    """
+    return curve_from_counts(stim, *spike_counts_latency(dset, fs, threshold, channel, window, absval, progress,
+                                                         polarity))
+
+
+def curve_from_counts(stim, counts, latency):
+    """Tuning curve from the spike counts and first spike latencies of every (trace, rep) of a test
+
+    :param stim: stimulus parameters of the test
+    :type stim: :class:`StimTable<util.stiminfo.StimTable>`
+    :param counts: spike counts, indexed by (trace, rep)
+    :type counts: numpy array
+    :param latency: first spike latencies, indexed by (trace, rep)
+    :type latency: numpy array
+    :returns: :class:`TuningCurve`
+    """
+    stimulus = np.asarray(stim.stim_type != 'silence', dtype=bool)
+    valid, frequency, intensity, cell = _grid_cells(stim.frequency[stimulus] / 1000, stim.intensity[stimulus])
+    shape = (len(intensity), len(frequency))
+    spikes, presentations = _grid_sums(cell, shape, counts[stimulus][valid])
+    with np.errstate(invalid='ignore', divide='ignore'):
+        Z = np.where(presentations > 0, spikes / presentations.astype(float), np.nan)
+    cells = cell_stats(cell, shape, counts[stimulus][valid], latency[stimulus][valid])
+    return TuningCurve(frequency, intensity, Z, spikes, presentations, counts, cells, latency)
+
+
+def _grid_cells(frequency, intensity):
+    """Places traces in a frequency x intensity grid
+
+    :returns: (valid, frequency, intensity, cell) -- which traces have a frequency and intensity,
+    the sorted unique frequencies and intensities, and the flat (intensity, frequency) cell of each valid trace
+    """
+    valid = np.isfinite(frequency) & np.isfinite(intensity)
+    frequency, ix = np.unique(frequency[valid], return_inverse=True)
+    intensity, iy = np.unique(intensity[valid], return_inverse=True)
+    return valid, frequency, intensity, iy * len(frequency) + ix
+
+
+def tuning_grid(frequency, intensity, counts):
+    """Sums the spike counts and presentations of traces into a frequency x intensity grid
+
+    Each trace is placed in its cell by the inverse indices of np.unique, and all
+    traces are added in at once, so repeated stimuli add up in the same cell.
+    Traces without a frequency or intensity (nan) are left out; cells no trace
+    falls in have no presentations.
+
+    :param frequency: frequency of each trace
+    :type frequency: numpy array
+    :param intensity: intensity of each trace
+    :type intensity: numpy array
+    :param counts: spike counts, indexed by (trace, rep)
+    :type counts: numpy array
+    :returns: (frequency, intensity, spikes, presentations) -- sorted unique frequencies
+    and intensities, and total spikes and presentations of each cell, indexed by (intensity, frequency)
+    """
+    valid, frequency, intensity, cell = _grid_cells(frequency, intensity)
+    spikes, presentations = _grid_sums(cell, (len(intensity), len(frequency)), counts[valid])
+    return frequency, intensity, spikes, presentations
+
+
+def _grid_sums(cell, shape, counts):
+    """Total spikes and presentations of each cell, given the flat cell of each trace"""
+    size = shape[0] * shape[1]
+    spikes = np.bincount(cell, weights=counts.sum(axis=1), minlength=size).astype(int).reshape(shape)
+    presentations = np.bincount(cell, minlength=size).reshape(shape) * counts.shape[1]
+    return spikes, presentations
+
+
+def cell_stats(cell, shape, counts, latency):
+    """Spike statistics of each cell of a frequency x intensity grid, from the counts and latencies of its presentations
+
+    Traces are placed in cells as :func:`tuning_grid` places them. The result is a
+    structured array with the fields:
+
+    * count -- number of presentations
+    * mean -- mean spikes per presentation
+    * var -- sample variance of the spikes per presentation (ddof=1)
+    * sem -- standard error of the mean
+    * latency -- median first spike latency in seconds, over the presentations with spikes
+    * rep_counts -- spike count of each presentation, in trace then rep order, padded with -1
+
+    Statistics that a cell has too few presentations for are nan.
+
+    :param cell: flat (intensity, frequency) cell of each trace, as :func:`_grid_cells` gives it
+    :type cell: numpy array
+    :param shape: (number of intensities, number of frequencies) of the grid
+    :type shape: (int, int)
+    :param counts: spike counts of the traces in cell, indexed by (trace, rep)
+    :type counts: numpy array
+    :param latency: first spike latencies of the traces in cell, indexed by (trace, rep)
+    :type latency: numpy array
+    :returns: numpy structured array, indexed by (intensity, frequency)
+    """
+    nreps = counts.shape[1]
+    size = shape[0] * shape[1]
+    # one entry per presentation
+    cell = np.repeat(cell, nreps)
+    counts = counts.ravel()
+    latency = latency.ravel()
+
+    n = np.bincount(cell, minlength=size)
+    total = np.bincount(cell, weights=counts, minlength=size)
+    squares = np.bincount(cell, weights=counts.astype(float) ** 2, minlength=size)
+    maxn = n.max() if size > 0 else 0
+    cells = np.zeros(size, dtype=[('count', int), ('mean', float), ('var', float), ('sem', float),
+                                  ('latency', float), ('rep_counts', int, (maxn,))])
+    cells['count'] = n
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cells['mean'] = total / n
+        cells['var'] = np.where(n > 1, (squares - total * cells['mean']) / (n - 1), np.nan)
+        cells['sem'] = np.sqrt(cells['var'] / n)
+
+    # presentations sorted by cell, keeping their order within it
+    order = np.argsort(cell, kind='mergesort')
+    starts = np.cumsum(n) - n
+    rep_counts = np.full((size, maxn), -1, dtype=int)
+    rep_counts[cell[order], np.arange(len(order)) - starts[cell[order]]] = counts[order]
+    cells['rep_counts'] = rep_counts
+
+    # median of each cell's latencies, from the latencies sorted by cell then value
+    has_spike = np.isfinite(latency)
+    lat_cell = cell[has_spike]
+    lat = latency[has_spike]
+    order = np.lexsort((lat, lat_cell))
+    lat = lat[order]
+    nlat = np.bincount(lat_cell, minlength=size)
+    lat_start = np.cumsum(nlat) - nlat
+    median = np.full(size, np.nan)
+    some = nlat > 0
+    median[some] = (lat[lat_start[some] + (nlat[some] - 1) // 2] + lat[lat_start[some] + nlat[some] // 2]) / 2
+    cells['latency'] = median
+    return cells.reshape(shape)
+
+
+def threshold_sweep(dset, fs, thresholds, channel=None, window=None, absval=True, progress=None, polarity=1):
+    """Counts the spikes of every (trace, rep) of a test at each of many thresholds, reading it once
+
+    The peaks of each trace are indexed once, sorted by amplitude, and the spikes
+    at each threshold are found from the index. They are those :func:`spike_counts`
+    detects, so the counts at a threshold are those of a tuning curve at that
+    threshold. Takes the parameters of :func:`spike_counts`, with thresholds
+    instead of a single threshold.
+
+    :param thresholds: threshold values to count spikes at
+    :type thresholds: sequence of float
+    :returns: numpy array of spike counts, indexed by (threshold, trace, rep)
+    """
+    if len(dset.shape) == 3:
+        channel = None
+
+    counts = np.zeros((len(thresholds),) + dset.shape[:2], dtype=int)
+    for start, stop, block in iter_chunks(dset, channel):
+        for itrace in range(stop - start):
+            index = PeakIndex.from_block(block[itrace], fs, absval, polarity)
+            for ithresh, threshold in enumerate(thresholds):
+                samples, offsets = index.spike_samples(threshold)
+                if window is not None:
+                    samples, offsets = window_samples(samples, offsets, int(np.floor(window[0] * fs)),
+                                                      int(np.floor(window[1] * fs)))
+                counts[ithresh, start + itrace] = np.diff(offsets)
+            if progress is not None:
+                progress(start + itrace + 1, dset.shape[0])
+    return counts
+
+
+def sweep_thresholds(dset, channel=None, trace=None, num=50):
+    """Thresholds for a sweep, from near zero to above the average maximum that auto_threshold uses
+
+    :returns: numpy array of num thresholds
+    """
+    peak = auto_threshold(dset, channel, trace, fraction=1)
+    return np.linspace(0.02, 1.5, num) * peak
+
+
+def auto_threshold(dset, channel=None, trace=None, fraction=THRESH_FRACTION):
+    """Threshold from the average maximum absolute value of the reps of a trace, or of all traces
+
+    The noise thresholds ('mad' and 'percentile') are those of
+    :class:`PeakStats<util.peakstats.PeakStats>`.
+
+    :param dset: test dataset
+    :type dset: h5py.Dataset
+    :param channel: channel to use, for multi-channel tests
+    :type channel: int
+    :param trace: trace to use, or None for all of them
+    :type trace: int
+    :param fraction: fraction of the average maximum to return
+    :type fraction: float
+    :returns: float -- threshold value
+    """
+    if len(dset.shape) == 3:
+        channel = None
+    if trace is not None:
+        return fraction * np.abs(read_block(dset, trace, channel=channel)).max(axis=-1).mean()
+    peaks = [np.abs(block).max(axis=-1).ravel() for _, _, block in iter_chunks(dset, channel)]
+    return fraction * np.concatenate(peaks).mean()
+
+
+def contour_levels(zmin, zmax, nlevels):
+    """Evenly spaced contour level boundaries for nlevels levels between zmin and zmax"""
+    return np.linspace(zmin, zmax, num=(nlevels + 1))
+
+
+def draw(fig, curve, title, threshold, levels=None):
+    """Draws a filled contour plot of a tuning curve on a matplotlib figure
+
+    :param fig: figure to draw on
+    :type fig: matplotlib.figure.Figure
+    :param curve: tuning curve to plot
+    :type curve: :class:`TuningCurve`
+    :param title: plot title
+    :type title: str
+    :param threshold: threshold used, noted on the figure
+    :type threshold: float
+    :param levels: contour level boundaries. If None, they are assigned automatically
+    :type levels: numpy array
+    """
+    ax = fig.add_subplot(111)
+    # place cells at their own frequencies and intensities, which need not be evenly spaced
+    X, Y = np.meshgrid(curve.frequency, curve.intensity)
+    # cells with no presentations are left blank
+    Z = np.ma.masked_invalid(curve.Z)
+    if levels is not None:
+        cp = ax.contourf(X, Y, Z, levels)
+    else:
+        cp = ax.contourf(X, Y, Z)
+    fig.colorbar(cp, ax=ax, label='Mean Spikes Per Presentation')
+    ax.set_title(title)
+    ax.set_xlabel('Frequency (kHz)')
+    ax.set_ylabel('Intensity (dB)')
+    fig.text(.02, .02, 'Threshold: ' + str(threshold) + ' V')
+
+
+def draw_sweep(fig, thresholds, counts, stim, title, threshold=None):
+    """Plots mean spikes per presentation against threshold, for stimulus and silence traces
+
+    :param fig: figure to draw on
+    :type fig: matplotlib.figure.Figure
+    :param thresholds: threshold values swept
+    :type thresholds: numpy array
+    :param counts: spike counts, indexed by (threshold, trace, rep), as returned by :func:`threshold_sweep`
+    :type counts: numpy array
+    :param stim: stimulus parameters of the test
+    :type stim: :class:`StimTable<util.stiminfo.StimTable>`
+    :param title: plot title
+    :type title: str
+    :param threshold: current threshold, marked on the plot
+    :type threshold: float
+    """
+    ax = fig.add_subplot(111)
+    silence = np.asarray(stim.stim_type == 'silence', dtype=bool)
+    if (~silence).any():
+        ax.plot(thresholds, counts[:, ~silence].mean(axis=(1, 2)), label='Stimulus')
+    if silence.any():
+        ax.plot(thresholds, counts[:, silence].mean(axis=(1, 2)), label='Silence')
+    if threshold is not None:
+        ax.axvline(threshold, color='r', linestyle='--', label='Current threshold')
+    ax.set_yscale('symlog')
+    ax.legend()
+    ax.set_title(title)
+    ax.set_xlabel('Threshold (V)')
+    ax.set_ylabel('Mean Spikes Per Presentation')
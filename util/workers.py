@@ -0,0 +1,171 @@
+"""Workers that run long computations off the GUI thread
+
+A worker is moved to a QThread and started by connecting the thread's started
+signal to its run slot. It reports back through signals, so the GUI stays
+responsive; done is always emitted last and can be used to stop the thread.
+"""
+import traceback
+
+from QtWrapper import QtCore
+
+import peakstats
+import tuning
+from datasource import DataSession
+from spikememo import SpikeMemo
+from spikestore import stored_spikes
+
+
+class TestWorker(QtCore.QObject):
+    """Base of the workers that compute something from one test, with progress and cancellation
+
+    The worker opens its own handle on the data file, so the GUI can keep using its
+    session. Subclasses implement compute, passing _progress on as the progress callback.
+
+    :param filename: path of the Sparkle HDF5 file
+    :type filename: str
+    :param test: name of the test
+    :type test: str
+    """
+    progress = QtCore.Signal(int, int)
+    finished = QtCore.Signal(object)
+    failed = QtCore.Signal(str)
+    cancelled = QtCore.Signal()
+    done = QtCore.Signal()
+
+    def __init__(self, filename, test):
+        super(TestWorker, self).__init__()
+        self.filename = filename
+        self.test = test
+        self._cancel = False
+
+    def cancel(self):
+        """Asks the computation to stop after the trace in progress"""
+        self._cancel = True
+
+    def compute(self, session):
+        """Computes the result from the open data file
+
+        :param session: the worker's handle on the file
+        :type session: :class:`DataSession<util.datasource.DataSession>`
+        """
+        raise NotImplementedError
+
+    def run(self):
+        """Runs compute, emitting finished with its result, or failed with the error, or cancelled"""
+        try:
+            session = DataSession(self.filename)
+            try:
+                result = self.compute(session)
+            finally:
+                session.close()
+        except tuning.Cancelled:
+            self.cancelled.emit()
+        except Exception:
+            self.failed.emit(traceback.format_exc())
+        else:
+            self.finished.emit(result)
+        self.done.emit()
+
+    def _progress(self, ndone, total):
+        if self._cancel:
+            raise tuning.Cancelled()
+        self.progress.emit(ndone, total)
+
+
+class TuningCurveWorker(TestWorker):
+    """Computes a tuning curve; finished is emitted with the :class:`TuningCurve<util.tuning.TuningCurve>`
+
+    :param threshold: Threshold value to determine spikes
+    :type threshold: float
+    :param channel: channel to use, for multi-channel tests
+    :type channel: int
+    :param window: (start, stop) times in seconds to count spikes between
+    :type window: (float, float)
+    :param absval: Whether to apply absolute value to signal before thresholding
+    :type absval: bool
+    :param polarity: 1, or -1 to invert the signal before thresholding
+    :type polarity: int
+    :param store: path of a :class:`SpikeStore<util.spikestore.SpikeStore>` to reuse and keep
+    detected spikes in, or None to always detect them. After the run, stored tells
+    whether the spikes came from the store.
+    :type store: str
+    :param memo: in-memory spikes to reuse and keep detected spikes in, looked up before the store.
+    After the run, memoized tells whether the spikes came from it.
+    :type memo: :class:`SpikeMemo<util.spikememo.SpikeMemo>`
+    """
+    def __init__(self, filename, test, threshold, channel=None, window=None, absval=True, polarity=1, store=None,
+                 memo=None):
+        super(TuningCurveWorker, self).__init__(filename, test)
+        self.threshold = threshold
+        self.channel = channel
+        self.window = window
+        self.absval = absval
+        self.polarity = polarity
+        self.store = store
+        self.stored = False
+        self.memo = memo
+        self.memoized = False
+
+    def compute(self, session):
+        dset = session.dataset(self.test)
+        fs = session.info(self.test).samplerate
+        channel = self.channel if len(dset.shape) == 4 else None
+        key = SpikeMemo.key(self.filename, self.test, channel, self.threshold, self.absval, self.polarity)
+        spikes = self.memo.get(key) if self.memo is not None else None
+        self.memoized = spikes is not None
+        if spikes is None:
+            if self.store is None:
+                spikes = tuning.detect_spikes(dset, fs, self.threshold, channel, self.absval, self._progress,
+                                              self.polarity)
+            else:
+                spikes, self.stored = stored_spikes(self.store, self.filename, dset, fs, self.test, self.threshold,
+                                                    channel, self.absval, self._progress, self.polarity)
+            if self.memo is not None:
+                self.memo.put(key, spikes)
+        # spikes are kept for whole recordings, so a new window needs no detection
+        counts, latency = tuning.counts_latency(*(tuning.window_spikes(spikes, self.window, fs) + (fs,)))
+        return tuning.curve_from_counts(session.stim_table(self.test), counts, latency)
+
+
+class ThresholdSweepWorker(TestWorker):
+    """Counts the spikes of a test at many thresholds
+
+    Takes the parameters of :class:`TuningCurveWorker`, with the thresholds of
+    :func:`sweep_thresholds<util.tuning.sweep_thresholds>` instead of a single
+    threshold. finished is emitted with (thresholds, counts indexed by
+    (threshold, trace, rep), stimulus table of the test).
+
+    :param trace: trace to take the range of thresholds from, or None for the whole test
+    :type trace: int
+    :param num: number of thresholds
+    :type num: int
+    """
+    def __init__(self, filename, test, trace=None, num=50, channel=None, window=None, absval=True, polarity=1):
+        super(ThresholdSweepWorker, self).__init__(filename, test)
+        self.trace = trace
+        self.num = num
+        self.channel = channel
+        self.window = window
+        self.absval = absval
+        self.polarity = polarity
+
+    def compute(self, session):
+        dset = session.dataset(self.test)
+        thresholds = tuning.sweep_thresholds(dset, self.channel, self.trace, self.num)
+        counts = tuning.threshold_sweep(dset, session.info(self.test).samplerate, thresholds, self.channel,
+                                        self.window, self.absval, self._progress, self.polarity)
+        return thresholds, counts, session.stim_table(self.test)
+
+
+class PeakStatsWorker(TestWorker):
+    """Computes the :class:`PeakStats<util.peakstats.PeakStats>` of every trace, rep and channel of a test
+
+    :param sketches: whether to sketch the channels too, for the 'mad' and 'percentile' thresholds
+    :type sketches: bool
+    """
+    def __init__(self, filename, test, sketches=False):
+        super(PeakStatsWorker, self).__init__(filename, test)
+        self.sketches = sketches
+
+    def compute(self, session):
+        return peakstats.peak_stats(session.dataset(self.test), progress=self._progress, sketches=self.sketches)